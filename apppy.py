@@ -5,6 +5,14 @@ import time
 
 from functools import reduce
 
+# The helpers are kept out of this generated file
+from apppy_transport import *
+from apppy_cache import *
+from apppy_local import *
+from apppy_streams import *
+from apppy_tools import *
+from apppy_client import client
+
 class ratelimit(object):
     """ Class that manages rate limits. It may include higher level math to optimize sleep times, etc.
 Parameters:
@@ -60,14 +68,14 @@ Method:setlimit(r): get the rate limit parameters from the response header and s
             self._wremaining = remaining
             # Reminder: writes also affect global. I don't know the global limit, 
             # but I can at least make a guess about remaining.
-            if self._gremaining > 0:
+            if self._gremaining:
                 self._gremaining -= 1
         else:
             self._glimit = limit
             self._greset = reset
             self._gremaining = remaining
 
-class apppy(ratelimit):
+class apppy(client, ratelimit):
     """ Usage: apppy(access_token=None, api_access_token=None)"""
     
     public_api_anchor = "alpha-api.app.net"
@@ -98,6 +106,10 @@ class apppy(ratelimit):
                          "If true, tell API to return 429 error codes, instead of automaticallyh sleeping")
 
     def __init__(self, access_token=None, app_access_token=None):
+        ratelimit.__init__(self)
+        client.__init__(self)
+        self._access_token = None
+        self._app_access_token = None
         self.gimme_429 = False
         if access_token:
             self.set_accesstoken(access_token)
@@ -174,7 +186,11 @@ Note that this sets access_token but doesn't save it."""
 
     def createUserStream(self, connection_id=None, timeout=None):
         h={"Authorization": "BEARER "+self.access_token}
-        r=requests.get("https://stream-channel.app.net/stream/user", stream=True, headers=h, timeout=None)
+        # timeout applies to every read of the stream. Without one, still bound the
+        # connect by the client deadline; reads wait for events as long as it takes.
+        if timeout is None and self.deadline is not None:
+            timeout = (self.deadline, None)
+        r=requests.get("https://stream-channel.app.net/stream/user", stream=True, headers=h, timeout=timeout)
         return r
     
         
@@ -200,7 +216,8 @@ Note that this sets access_token but doesn't save it."""
         for p in params:
             if p in self.parameter_category:
                 if ret == None:
-                    ret = self.parameter_category[p]
+                    # copy, so the += and append below don't grow parameter_category itself
+                    ret = self.parameter_category[p][:]
                 else:
                     ret += self.parameter_category[p]
             else:
@@ -212,6 +229,9 @@ Note that this sets access_token but doesn't save it."""
         
     #Generic REQUESTS
     def genRequest(self, url, ep_data, params):
+        # profiles, deadlines, lanes and the other apppy options (see apppy_client)
+        opts = self.callopts(url, ep_data, params)
+
         rp={}
         for p in ("headers", "params", "data"):
             if p in params:
@@ -261,29 +281,8 @@ Note that this sets access_token but doesn't save it."""
         if isjson:
             rp['data'] = json.dumps(rp['data'])
         #print url, rp
-        # we repeat the call in case of a 429
-        for i in range(2):
-            r = call(url, **rp)
-            if r.status_code == 429:
-                # 429 is "Rate limit exceeded. Need to sleep before you try again"
-                # http://developers.app.net/docs/basics/rate-limits/
-                # App.net asks that any client respect 429 and sleep RetryAfter seconds 
-                # before trying again. In the normal case, we handle the sleeping 
-                # ourselves. If the caller is clever, they can do api.gimme_429=True 
-                # in which case it'll raise a 429 error that they're able to catch.
-                # If they're clever enough to set gimme_429, but not clever enough 
-                # to catch it, then app.net is still happy.
-                #
-                # Only do this once. If i > 0 (second time through the loop), just raise
-                if i > 0 or self.gimme_429:
-                    r.raise_for_status()
-                    return {} # shouldn't get here. This just in case...
-                time.sleep(float(r.headers['RetryAfter']))
-                # repeat the call
-                continue
-
-            return r
-        return r
+        # retries, 429s, rate limits and hedging are handled by send
+        return self.send(call, url, ep_data, rp, opts)
     base="https://alpha-api.app.net/stream/0/"
     parameter_category={'general_channel': ['channel_types', 'include_marker', 'include_read', 'include_recent_message', 'include_annotations', 'include_user_annotations', 'include_message_annotations', 'connection_id'], 'post_or_message': ['text'], 'file_ids': ['ids'], 'file': ['kind', 'type', 'name', 'public', 'annotations'], 'marker': ['id', 'name', 'percentage'], 'message': ['text', 'reply_to', 'annotations', 'entities', 'machine_only', 'destinations'], 'message_ids': ['ids'], 'UserStream': [], 'post_search': ['index', 'order', 'query', 'text', 'hashtags', 'links', 'link_domains', 'mentions', 'leading_mentions', 'annotation_types', 'attachment_types', 'crosspost_url', 'crosspost_domain', 'place_id', 'is_reply', 'is_directed', 'has_location', 'has_checkin', 'is_crosspost', 'has_attachment', 'has_oembed_photo', 'has_oembed_video', 'has_oembed_html5video', 'has_oembed_rich', 'language', 'client_id', 'creator_id', 'reply_to', 'thread_id'], 'content': 'content', 'place_search': ['latitude', 'longitude', 'q', 'radius', 'count', 'remove_closed', 'altitude', 'horizontal_accuracy', 'vertical_accuracy'], 'channel': ['readers', 'writers', 'annotations', 'type'], 'channel_ids': ['ids'], 'user_ids': ['ids'], 'user_search': ['q', 'count'], 'general_message': ['include_muted', 'include_deleted', 'include_machine', 'include_annotations', 'include_user_annotations', 'include_message_annotations', 'include_html', 'connection_id'], 'user': ['name', 'locale', 'timezone', 'description'], 'AppStream': ['object_types', 'type', 'filter_id', 'key'], 'post': ['text', 'reply_to', 'machine_only', 'annotations', 'entities'], 'general_file': ['file_types', 'include_incomplete', 'include_private', 'include_annotations', 'include_file_annotations', 'include_user_annotations', 'connection_id'], 'general_post': ['include_muted', 'include_deleted', 'include_directed_posts', 'include_machine', 'include_starred_by', 'include_reposters', 'include_annotations', 'include_post_annotations', 'include_user_annotations', 'include_html', 'connection_id'], 'pagination': ['since_id', 'before_id', 'count'], 'general_user': ['include_annotations', 'include_user_annotations', 'include_html', 'connection_id'], 'cover': 'image', 'filter': ['name', 'match_policy', 'clauses'], 'avatar': 'image', 'post_ids': ['ids'], 'stream_facet': ['has_oembed_photo'], 'channel_search': ['order', 'q', 'type', 'creator_id', 'tags']}
     allscopes=['files', 'follow', 'update_profile', 'stream', 'messages', 'public_messages', 'export', 'basic', 'write_post', 'email']
@@ -964,7 +963,7 @@ Note that this sets access_token but doesn't save it."""
         """api.destroySubscriptionUserStream(connection_id, subscription_id) - Delete a User Stream Subscription
         
         http://developers.app.net/docs/resources/user-stream/lifecycle/#delete-a-user-stream-subscription"""
-        ep={'url_params': ['connection_id', 'subscription_id'], 'group': 'UserStream', 'name': 'destroySubscription', 'array_params': [], 'data_params': [], 'get_params': [], 'url': ['streams/me/streams/'], 'token': 'user', 'link': 'http://developers.app.net/docs/resources/user-stream/lifecycle/#delete-a-user-stream-subscription', 'scope': 'basic', 'method': 'DELETE', 'description': 'Delete a User Stream Subscription'}
+        ep={'url_params': ['connection_id', 'subscription_id'], 'group': 'UserStream', 'name': 'destroySubscription', 'array_params': [], 'data_params': [], 'get_params': [], 'url': ['streams/me/streams/', '/subscriptions/'], 'token': 'user', 'link': 'http://developers.app.net/docs/resources/user-stream/lifecycle/#delete-a-user-stream-subscription', 'scope': 'basic', 'method': 'DELETE', 'description': 'Delete a User Stream Subscription'}
         url=self.geturl(ep , connection_id, subscription_id)
         return self.genRequest(url, ep, kargs)
 
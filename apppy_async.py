@@ -0,0 +1,215 @@
+""" asyncio helpers for apppy. Python 3 only, which is why they are not in apppy.py."""
+import asyncio
+import json
+import ssl
+import concurrent.futures
+
+from apppy import apppy
+
+
+class userstream(object):
+    """ One user stream connection of a userstreammux."""
+
+    def __init__(self, account, api):
+        self.account = account
+        self.api = api
+        self.connection_id = None
+        self.subscriptions = {}     # subscription id -> (method name, args, kargs)
+        self.connected = asyncio.Event()
+        self.error = None
+        self.reconnects = 0
+        self.events = 0
+        self.task = None
+        self.writer = None
+
+
+class userstreammux(object):
+    """ Multiplexes many user streams, each with its own token, on one asyncio loop.
+Usage:
+mux = userstreammux()
+await mux.add("alice", access_token=alice_token)
+await mux.subscribe("alice", "getUnifiedStreamPost")
+await mux.subscribe("alice", "getUserSubscribedChannel", include_read=1)
+async for account, event in mux.events():
+    ...
+
+Each connection is one coroutine reading the streaming HTTP response, so thousands of
+them fit in one process. The subscription calls are ordinary apppy calls run in a
+small thread pool, with connection_id filled in. If a connection drops, it is reopened
+and its subscriptions are made again on the new Connection-Id, and a
+{"meta": {"type": "reconnect"}} event is delivered for that account, since events may
+have been missed. add() raises if the first connection fails. A stream that can't be
+reopened (its token was refused) is removed, and {"meta": {"type": "error"}} is
+delivered for its account. Events are delivered as (account, event) on one bounded queue;
+when the consumer falls behind, the connections stop reading.
+"""
+
+    host = "stream-channel.app.net"
+    port = 443
+    path = "/stream/user"
+    use_ssl = True
+
+    def __init__(self, queue_size=10000, workers=16, idle_timeout=300, client=apppy):
+        self.queue = asyncio.Queue(queue_size)
+        self.idle_timeout = idle_timeout
+        self.client = client
+        self.streams = {}
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self._ssl = ssl.create_default_context() if self.use_ssl else None
+
+    def _call(self, stream, name, *args, **kargs):
+        method = getattr(stream.api, name)
+        return asyncio.get_running_loop().run_in_executor(self._pool, lambda: method(*args, **kargs))
+
+    async def add(self, account, access_token=None, api=None):
+        """ Opens a user stream for account, with its token or apppy client."""
+        if account in self.streams:
+            raise ValueError("Account {0} already has a stream".format(account))
+        stream = userstream(account, api or self.client(access_token=access_token))
+        self.streams[account] = stream
+        stream.task = asyncio.ensure_future(self._run(stream))
+        await stream.connected.wait()
+        if stream.error:
+            del self.streams[account]
+            raise stream.error
+        return stream
+
+    async def remove(self, account):
+        """ Destroys an account's user stream and closes its connection."""
+        stream = self.streams.pop(account, None)
+        if stream is None:
+            return      # already dropped after an error event
+        stream.task.cancel()
+        if stream.writer is not None:
+            stream.writer.close()
+        if stream.connection_id:
+            await self._call(stream, 'destroyUserStream', stream.connection_id)
+
+    async def subscribe(self, account, name, *args, **kargs):
+        """ Calls endpoint name with the stream's connection_id. Returns the subscription id."""
+        stream = self.streams[account]
+        await stream.connected.wait()
+        if stream.error:
+            raise stream.error
+        r = await self._call(stream, name, *args, connection_id=stream.connection_id, **kargs)
+        r.raise_for_status()
+        sub_id = r.json().get('meta', {}).get('subscription_id')
+        stream.subscriptions[sub_id] = (name, args, kargs)
+        return sub_id
+
+    async def unsubscribe(self, account, subscription_id):
+        stream = self.streams[account]
+        del stream.subscriptions[subscription_id]
+        await self._call(stream, 'destroySubscriptionUserStream', stream.connection_id, subscription_id)
+
+    def stats(self):
+        return {'connections': len(self.streams),
+                'connected': len([s for s in self.streams.values() if s.connected.is_set()]),
+                'events': sum(s.events for s in self.streams.values()),
+                'reconnects': sum(s.reconnects for s in self.streams.values()),
+                'subscriptions': sum(len(s.subscriptions) for s in self.streams.values()),
+                'queued': self.queue.qsize()}
+
+    async def events(self):
+        while True:
+            yield await self.queue.get()
+
+    async def close(self):
+        for account in list(self.streams):
+            await self.remove(account)
+        self._pool.shutdown(False)
+
+    async def _run(self, stream):
+        delay = 1
+        while True:
+            try:
+                await asyncio.wait_for(self._connect(stream), self.idle_timeout)
+                delay = 1
+                await self._read(stream)
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                if stream.connection_id is None or isinstance(e, PermissionError):
+                    # never connected, or a bad or revoked token; reconnecting won't help
+                    return await self._fail(stream, e)
+                stream.api.dprint("user stream {0}: {1}".format(stream.account, e))
+            except Exception as e:
+                return await self._fail(stream, e)
+            stream.connected.clear()
+            stream.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def _fail(self, stream, e):
+        # add() raises the error of a stream that never connected. A stream that dies
+        # later is dropped, and its consumer gets an error event.
+        stream.error = e
+        stream.connected.set()
+        if stream.connection_id is not None and self.streams.get(stream.account) is stream:
+            del self.streams[stream.account]
+            await self.queue.put((stream.account, {'meta': {'type': 'error', 'error_message': str(e)}}))
+
+    async def _connect(self, stream):
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self._ssl)
+        writer.write("GET {0} HTTP/1.1\r\nHost: {1}\r\nAuthorization: Bearer {2}\r\n"
+                     "Accept: application/json\r\n\r\n".format(
+                         self.path, self.host, stream.api.access_token).encode('ascii'))
+        status = await reader.readline()
+        if b" 401 " in status or b" 403 " in status:
+            writer.close()
+            raise PermissionError("User stream refused for {0}: {1}".format(stream.account, status.strip()))
+        if b" 200 " not in status:
+            writer.close()
+            raise ValueError("Could not open user stream: {0}".format(status.strip()))
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        stream.reader, stream.writer = reader, writer
+        stream.chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        reconnected = stream.connection_id is not None
+        stream.connection_id = headers['connection-id']
+        stream.connected.set()
+        if reconnected:
+            # the old subscriptions died with the old Connection-Id
+            old, stream.subscriptions = stream.subscriptions, {}
+            try:
+                for sub_id, (name, args, kargs) in list(old.items()):
+                    await self.subscribe(stream.account, name, *args, **kargs)
+                    del old[sub_id]
+            except BaseException:
+                # the ones not made yet are tried again on the next connection
+                stream.subscriptions.update(old)
+                raise
+            await self.queue.put((stream.account, {'meta': {'type': 'reconnect'}}))
+
+    async def _chunks(self, stream):
+        reader = stream.reader
+        while True:
+            if not stream.chunked:
+                data = await asyncio.wait_for(reader.read(65536), self.idle_timeout)
+                if not data:
+                    return
+                yield data
+                continue
+            size = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            size = int(size.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                return
+            data = await reader.readexactly(size + 2)
+            yield data[:-2]
+
+    async def _read(self, stream):
+        buf = b""
+        async for data in self._chunks(stream):
+            buf += data
+            lines = buf.split(b"\r\n")
+            buf = lines.pop()
+            for line in lines:
+                if line.strip():
+                    stream.events += 1
+                    await self.queue.put((stream.account, json.loads(line.decode('utf-8'))))
+        raise ValueError("user stream closed by server")
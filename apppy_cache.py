@@ -0,0 +1,361 @@
+""" Local caches and compact containers for apppy responses."""
+import time
+import math
+import bisect
+import threading
+
+from array import array
+from collections import OrderedDict
+
+# typecode for arrays of 64 bit object ids ('q' needs python 3.3)
+try:
+    array('q')
+    idtype = 'q'
+except ValueError:
+    idtype = 'l'
+
+
+__all__ = ['placecache', 'idset', 'entitystore']
+
+
+class placecache(object):
+    """ Cache for getPlace and searchPlace with a grid index over place coordinates.
+Usage:
+places = placecache(ttl=3600, maxsize=10000)
+places.search(api, latitude=52.37, longitude=4.89, radius=500, q="coffee")
+places.get(api, factual_id)
+
+A search is answered locally when an earlier, unexpired search with the same q
+(and other parameters) covered the whole requested circle, was not cut off by its
+count and still has all its places cached. It is answered with the places that
+search returned, or for searches without q or other parameters, with every cached
+place in the circle. Otherwise searchPlace is called and its results cached. Either
+way the places within radius are returned, nearest first. Places are kept
+once per factual_id, the most recent version winning, and expire after ttl seconds;
+beyond maxsize the least recently used are evicted. Both methods return place
+objects, not responses. hits and misses count answers from the cache and from the API.
+"""
+
+    cell = 0.01             # grid cell size in degrees, about a kilometer
+    default_radius = 100    # meters, used when a search gives no radius
+    default_count = 20
+
+    def __init__(self, ttl=3600, maxsize=10000, maxsearches=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxsearches = maxsearches
+        self.places = OrderedDict()
+        self.grid = {}
+        self.searches = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def distance(lat1, lon1, lat2, lon2):
+        """ Great circle distance in meters."""
+        p1, p2 = math.radians(lat1), math.radians(lat2)
+        a = math.sin((p2 - p1) / 2) ** 2 + \
+            math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+        return 2 * 6371000 * math.asin(min(1, math.sqrt(a)))
+
+    def _cellof(self, lat, lon):
+        return (int(math.floor(lat / self.cell)), int(math.floor(lon / self.cell)))
+
+    def _drop(self, fid):
+        place, expires = self.places.pop(fid)
+        if 'latitude' in place:
+            c = self.grid.get(self._cellof(place['latitude'], place['longitude']))
+            if c is not None:
+                c.discard(fid)
+
+    def add(self, place):
+        with self._lock:
+            fid = place['factual_id']
+            if fid in self.places:
+                self._drop(fid)
+            self.places[fid] = (place, time.time() + self.ttl)
+            if 'latitude' in place:
+                self.grid.setdefault(self._cellof(place['latitude'], place['longitude']), set()).add(fid)
+            while len(self.places) > self.maxsize:
+                self._drop(next(iter(self.places)))
+            return place
+
+    def lookup(self, factual_id):
+        """ The cached place, or None."""
+        with self._lock:
+            entry = self.places.get(factual_id)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                self._drop(factual_id)
+                return None
+            # move to the end; most recently used
+            del self.places[factual_id]
+            self.places[factual_id] = entry
+            return entry[0]
+
+    def get(self, api, factual_id):
+        place = self.lookup(factual_id)
+        if place is not None:
+            self.hits += 1
+            return place
+        self.misses += 1
+        r = api.getPlace(factual_id)
+        r.raise_for_status()
+        return self.add(r.json()['data'])
+
+    def _covered(self, key, lat, lon, radius):
+        """ The cached places of an earlier search covering the circle, or None."""
+        now = time.time()
+        for skey, (expires, fids) in list(self.searches.items()):
+            if expires < now:
+                del self.searches[skey]
+            elif skey[0] == key and self.distance(lat, lon, skey[1], skey[2]) + radius <= skey[3]:
+                places = [self.lookup(fid) for fid in fids]
+                if None in places:
+                    # some of its places were evicted or expired; it can't answer in full
+                    del self.searches[skey]
+                    continue
+                return places
+        return None
+
+    def nearby(self, lat, lon, radius):
+        """ Cached places within radius meters, nearest first."""
+        dlat = radius / 111000.0
+        dlon = dlat / max(0.01, math.cos(math.radians(lat)))
+        (y0, x0), (y1, x1) = self._cellof(lat - dlat, lon - dlon), self._cellof(lat + dlat, lon + dlon)
+        found = []
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                for fid in list(self.grid.get((y, x), ())):
+                    place = self.lookup(fid)
+                    if place is not None:
+                        found.append(place)
+        return self._within(found, lat, lon, radius)
+
+    def _within(self, places, lat, lon, radius):
+        found = []
+        for place in places:
+            if 'latitude' in place:
+                d = self.distance(lat, lon, place['latitude'], place['longitude'])
+                if d <= radius:
+                    found.append((d, place))
+        found.sort(key=lambda dp: dp[0])
+        return [p for d, p in found]
+
+    def search(self, api, latitude, longitude, radius=None, q=None, count=None, **params):
+        radius = radius or self.default_radius
+        key = tuple(sorted(params.items())) + (('q', q.lower() if q else None),)
+        with self._lock:
+            places = self._covered(key, latitude, longitude, radius)
+            if places is not None:
+                self.hits += 1
+                if q or params:
+                    # only the places the server matched; q also matches more than the name
+                    found = self._within(places, latitude, longitude, radius)
+                else:
+                    found = self.nearby(latitude, longitude, radius)
+                return found[:count] if count else found
+        self.misses += 1
+        kargs = dict(params, latitude=latitude, longitude=longitude, radius=radius)
+        if q:
+            kargs['q'] = q
+        if count:
+            kargs['count'] = count
+        r = api.searchPlace(**kargs)
+        r.raise_for_status()
+        places = r.json()['data']
+        with self._lock:
+            for place in places:
+                self.add(place)
+            if len(places) < (count or self.default_count):
+                # The server returned everything in the circle, so it can answer later searches.
+                self.searches[(key, latitude, longitude, radius)] = \
+                    (time.time() + self.ttl, [p['factual_id'] for p in places])
+                while len(self.searches) > self.maxsearches:
+                    self.searches.popitem(False)
+        # the same order and cut as an answer from the cache
+        found = self._within(places, latitude, longitude, radius)
+        return found[:count] if count else found
+
+
+class idset(object):
+    """ Immutable sorted set of integer ids, backed by an array of 64 bit integers
+(8 bytes per id instead of a python string each).
+Usage:
+followers = api.getFollowerIdsUser("me", as_idset=True)
+following = api.getFollowingIdsUser("me", as_idset=True)
+mutuals = followers & following
+unfollowers = old_followers - followers
+followers.tofile("followers.ids"); idset.fromfile("followers.ids")
+
+Supports len, in, iteration (ints, ascending), ==, & | - and the intersection,
+union and difference methods. tolist() gives back the string ids the API uses.
+Files are a 4 byte header followed by the raw array, in native byte order.
+"""
+
+    magic = b'IDS'
+
+    def __init__(self, ids=()):
+        self.ids = array(idtype, sorted(set(int(i) for i in ids)))
+
+    @classmethod
+    def _fromsorted(cls, ids):
+        s = cls.__new__(cls)
+        s.ids = ids if isinstance(ids, array) else array(idtype, ids)
+        return s
+
+    @classmethod
+    def load(cls, data):
+        """ An idset from an id list, or a dict of idsets from a dict of id lists."""
+        if isinstance(data, dict):
+            return dict((k, cls(v)) for k, v in data.items())
+        return cls(data)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, i):
+        i = int(i)
+        k = bisect.bisect_left(self.ids, i)
+        return k < len(self.ids) and self.ids[k] == i
+
+    def __eq__(self, other):
+        return isinstance(other, idset) and self.ids == other.ids
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "idset({0} ids)".format(len(self.ids))
+
+    def nbytes(self):
+        return len(self.ids) * self.ids.itemsize
+
+    def tolist(self):
+        return [str(i) for i in self.ids]
+
+    def intersection(self, other):
+        small, big = (self, other) if len(self) <= len(other) else (other, self)
+        if len(small) * 16 < len(big):
+            # much smaller: probe the big one instead of hashing it
+            return idset._fromsorted([i for i in small.ids if i in big])
+        return idset._fromsorted(sorted(set(small.ids).intersection(big.ids)))
+    __and__ = intersection
+
+    def union(self, other):
+        return idset._fromsorted(sorted(set(self.ids).union(other.ids)))
+    __or__ = union
+
+    def difference(self, other):
+        if len(other) * 16 < len(self):
+            drop = set(other.ids)
+            return idset._fromsorted([i for i in self.ids if i not in drop])
+        return idset._fromsorted([i for i in self.ids if i not in other])
+    __sub__ = difference
+
+    def tofile(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.magic + self.ids.typecode.encode('ascii'))
+            self.ids.tofile(f)
+
+    @classmethod
+    def fromfile(cls, path):
+        with open(path, 'rb') as f:
+            head = f.read(4)
+            if head[:3] != cls.magic:
+                raise ValueError("{0} is not an idset file".format(path))
+            ids = array(head[3:].decode('ascii'))
+            data = f.read()
+        if hasattr(ids, 'frombytes'):
+            ids.frombytes(data)
+        else:
+            ids.fromstring(data)
+        return cls._fromsorted(ids)
+
+
+class entitystore(object):
+    """ Identity map for users, posts, channels and messages across responses.
+Usage:
+api.entity_store = entitystore(maxsize=50000)
+body = api.decode(api.getGlobalPost())      # embedded users, repost_of, ... are interned
+
+Every object is replaced by the single shared dict for its id, so a timeline page
+holds each user once. When an object arrives again, the shared dict is updated in
+place: the newest version wins and earlier references see it. Each kind keeps at most
+maxsize objects, least recently seen evicted first. hits and misses count objects
+found in or added to the map.
+"""
+
+    # kind -> (field, kind) of the objects it embeds
+    embedded = {'user': (),
+                'post': (('user', 'user'), ('repost_of', 'post')),
+                'message': (('user', 'user'),),
+                'channel': (('owner', 'user'), ('recent_message', 'message'))}
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self.maps = dict((kind, OrderedDict()) for kind in self.embedded)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+    hit_rate = property(get_hit_rate, None, None, "Fraction of interned objects already in the map")
+
+    @staticmethod
+    def kindof(obj):
+        if 'username' in obj:
+            return 'user'
+        if 'channel_id' in obj:
+            return 'message'
+        if 'readers' in obj or 'writers' in obj:
+            return 'channel'
+        if 'thread_id' in obj:
+            return 'post'
+        return None
+
+    def intern(self, obj, kind=None):
+        kind = kind or self.kindof(obj)
+        if kind is None or 'id' not in obj:
+            return obj
+        for field, fkind in self.embedded[kind]:
+            if isinstance(obj.get(field), dict):
+                obj[field] = self.intern(obj[field], fkind)
+        with self._lock:
+            m = self.maps[kind]
+            current = m.pop(obj['id'], None)
+            if current is None:
+                self.misses += 1
+                current = obj
+            else:
+                self.hits += 1
+                if current is not obj:
+                    current.clear()
+                    current.update(obj)
+            m[obj['id']] = current
+            while len(m) > self.maxsize:
+                m.popitem(False)
+            return current
+
+    def load(self, body, kind=None):
+        """ Interns the objects in a response body ({"data": ...}) or a list of objects."""
+        data = body['data'] if isinstance(body, dict) and 'data' in body else body
+        if isinstance(data, list):
+            data[:] = [self.intern(o, kind) if isinstance(o, dict) else o for o in data]
+        elif isinstance(data, dict):
+            data = self.intern(data, kind)
+        if isinstance(body, dict) and 'data' in body:
+            body['data'] = data
+            return body
+        return data
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate,
+                'sizes': dict((k, len(m)) for k, m in self.maps.items())}
@@ -0,0 +1,604 @@
+""" The parts of the apppy client that are not generated from the endpoint list:
+rate limit budgets shared between clients, the request path genRequest hands its
+calls to, and higher level calls built on the endpoints. apppy.apppy inherits them."""
+import requests
+import json
+import time
+import threading
+import hashlib
+import contextlib
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from apppy_transport import CircuitOpenError, DeadlineExceeded
+from apppy_cache import idset
+from apppy_local import localfilter, textprocessor
+from apppy_streams import appstreamconsumer
+from apppy_tools import exporter
+
+__all__ = ['client']
+
+
+class client(object):
+    """ Mixin for apppy. genRequest calls callopts() before it builds a request and send()
+to make it.
+Parameters:
+ratelimit_backend: None, or a ratelimitstate (threads) or fileratelimit (processes)
+shared with other clients. With a backend, every client draws from the same budget
+per token, and acquire() makes callers wait instead of overshooting the limit.
+retry_policy, hedge_policy, scheduler: a retrypolicy, hedgepolicy or priorityscheduler.
+profile: a request profile for every call (see request_profiles).
+deadline: seconds every call may take, retries and rate limit waits included.
+capture: a trafficlog every call is recorded to.
+validate_writes: validate posts and messages locally before sending them.
+compact_ids: return idsets from the id list endpoints.
+entity_store: an entitystore decode() interns objects in.
+
+Method:acquire(key, write): wait until the shared budget allows one more call.
+Method:budget(kind, key): (limit, remaining, reset_at) of the 'global' or 'write' budget
+    of token key (the access token's by default).
+"""
+
+    def __init__(self):
+        self._wreset_at = None
+        self._greset_at = None
+        self.ratelimit_backend = None
+        self.retry_policy = None
+        self.profile = None
+        self.byte_stats = {}
+        self._bytes_lock = threading.Lock()
+        self._filters = {}
+        self.capture = None
+        self.validate_writes = False
+        self._config = None
+        self.compact_ids = False
+        self.entity_store = None
+        self.hedge_policy = None
+        self.scheduler = None
+        self._local = threading.local()
+        self.deadline = None
+
+    def ratelimit_key(self, token=None):
+        """ Backend key for a token. Tokens themselves are never stored."""
+        if token is None:
+            token = getattr(self, '_access_token', None) or ''
+        return hashlib.sha1(token.encode('utf-8')).hexdigest()[:16]
+
+    def _shared(self, kind, field):
+        b = self.ratelimit_backend.state(self.ratelimit_key()).get(kind)
+        if not b:
+            return None
+        if field == 'reset':
+            return None if b['reset_at'] is None else max(0, int(b['reset_at'] - time.time()))
+        return b[field]
+
+    def get_wlimit(self): return self._shared('write', 'limit') if self.ratelimit_backend else self._wlimit
+    def get_wreset(self): return self._shared('write', 'reset') if self.ratelimit_backend else self._wreset
+    def get_wremaining(self): return self._shared('write', 'remaining') if self.ratelimit_backend else self._wremaining
+    wlimit     = property(get_wlimit,     None, None,
+                          "Maximum number of accesses per period (write limit)")
+    wreset     = property(get_wreset,     None, None,
+                          "Time until full count is reset (write limit)")
+    wremaining = property(get_wremaining, None, None,
+                          "accesses remaining until reset time (write limit)")
+
+    def get_glimit(self): return self._shared('global', 'limit') if self.ratelimit_backend else self._glimit
+    def get_greset(self): return self._shared('global', 'reset') if self.ratelimit_backend else self._greset
+    def get_gremaining(self): return self._shared('global', 'remaining') if self.ratelimit_backend else self._gremaining
+    glimit     = property(get_glimit,     None, None,
+                          "Maximum number of accesses per period (global limit)")
+    greset     = property(get_greset,     None, None,
+                          "Time until full count is reset (global limit)")
+    gremaining = property(get_gremaining, None, None,
+                          "accesses remaining until reset time (global limit)")
+
+    def setlimit(self, r, key=None):
+        super(client, self).setlimit(r)
+        if r.request.method == "POST" or r.request.method == "DELETE":
+            kind, limit, reset, remaining = 'write', self._wlimit, self._wreset, self._wremaining
+            self._wreset_at = time.time() + reset
+        else:
+            kind, limit, reset, remaining = 'global', self._glimit, self._greset, self._gremaining
+            self._greset_at = time.time() + reset
+        if self.ratelimit_backend:
+            self.ratelimit_backend.update(key or self.ratelimit_key(), kind, limit, reset, remaining)
+
+    def budget(self, kind='global', key=None):
+        """ (limit, remaining, reset_at) for kind 'global' or 'write'; Nones while unknown.
+With a shared backend, key picks the token's budget (the access token's by default).
+Once reset_at has passed the budget is assumed to be full again."""
+        if self.ratelimit_backend:
+            b = self.ratelimit_backend.state(key or self.ratelimit_key()).get(kind)
+            if not b:
+                return (None, None, None)
+            limit, remaining, reset_at = b['limit'], b['remaining'], b['reset_at']
+        elif kind == 'write':
+            limit, remaining, reset_at = self._wlimit, self._wremaining, self._wreset_at
+        else:
+            limit, remaining, reset_at = self._glimit, self._gremaining, self._greset_at
+        if reset_at is not None and time.time() >= reset_at:
+            remaining = limit
+        return (limit, remaining, reset_at)
+
+    def acquire(self, key, write=False, expires=None):
+        """ Takes one call from the shared budget, sleeping until it is available.
+Raises DeadlineExceeded rather than sleeping past expires (a time.time() value)."""
+        if not self.ratelimit_backend:
+            return
+        kinds = ('write', 'global') if write else ('global',)
+        while True:
+            wait = self.ratelimit_backend.acquire(key, kinds)
+            if not wait:
+                return
+            if expires is not None and time.time() + wait > expires:
+                raise DeadlineExceeded("Rate limit budget exhausted for {0:.1f}s, past the deadline".format(wait))
+            time.sleep(wait)
+
+    @contextlib.contextmanager
+    def lane(self, name):
+        """with api.lane("background"): ...
+
+Runs the calls made by this thread in the block in a priorityscheduler lane."""
+        previous = getattr(self._local, 'lane', None)
+        self._local.lane = name
+        try:
+            yield
+        finally:
+            self._local.lane = previous
+
+    def decode(self, r):
+        """api.decode(r)
+
+The decoded body of response r. With api.entity_store set, its users, posts,
+channels and messages are shared with every other response decoded this way."""
+        body = r.json()
+        if self.entity_store is not None:
+            body = self.entity_store.load(body)
+        return body
+
+    def getInboxSnapshot(self, channel_types=None, count=20, message_count=5, workers=8, **params):
+        """api.getInboxSnapshot(channel_types=None, count=20, message_count=5, workers=8, **params)
+
+Everything needed to render an inbox, fetched in three stages:
+channels: the count most recent subscribed channels, with recent message, marker and read state
+messages: the latest message_count messages of every unread channel (or of every channel
+    without a recent message), fetched concurrently
+users: channel owners, writers and senders not embedded in the responses, in bulk
+Returns {'channels': [channel, ...], 'users': {id: user}, 'unread': {type: count},
+'timings': {stage: seconds}}. Each channel gets a 'messages' list. params (eg. priority,
+profile) are passed to every call. A deadline covers the whole snapshot: each call gets
+the time that is left. The calls run in the current api.lane() unless priority is given."""
+        import concurrent.futures
+        timings = {}
+        started = t = time.time()
+        deadline = params.pop('deadline', self.deadline)
+        expires = started + deadline if deadline is not None else None
+        lane = getattr(self._local, 'lane', None)
+        if lane is not None:
+            params.setdefault('priority', lane)
+        def left():
+            # params for the next call, with the time left before the snapshot's deadline
+            if expires is None:
+                return params
+            if time.time() >= expires:
+                raise DeadlineExceeded("Deadline passed during getInboxSnapshot")
+            return dict(params, deadline=expires - time.time())
+        kargs = dict(left(), include_recent_message=1, include_marker=1, include_read=1, count=count)
+        if channel_types:
+            kargs['channel_types'] = channel_types if hasattr(channel_types, 'split') else ",".join(channel_types)
+        r = self.getUserSubscribedChannel(**kargs)
+        r.raise_for_status()
+        channels = self.decode(r)['data']
+        timings['channels'] = time.time() - t
+
+        t = time.time()
+        users = {}
+        def fetch_messages(channel):
+            r = self.getChannelMessage(channel['id'], count=message_count, **left())
+            r.raise_for_status()
+            return self.decode(r)['data']
+        wanted = [c for c in channels
+                  if (message_count > 1 and c.get('has_unread')) or not c.get('recent_message')]
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            fetched = dict(zip([c['id'] for c in wanted], pool.map(fetch_messages, wanted)))
+            for c in channels:
+                if c['id'] in fetched:
+                    c['messages'] = fetched[c['id']]
+                else:
+                    c['messages'] = [c['recent_message']] if c.get('recent_message') else []
+            timings['messages'] = time.time() - t
+
+            t = time.time()
+            needed = set()
+            for c in channels:
+                for u in [c.get('owner')] + [m.get('user') for m in c['messages']]:
+                    if u:
+                        users[u['id']] = u
+                needed.update(c.get('writers', {}).get('user_ids', []))
+                needed.update(m['user_id'] for m in c['messages'] if 'user' not in m and m.get('user_id'))
+            needed = sorted(needed - set(users))
+            def fetch_users(ids):
+                r = self.getListUser(ids=",".join(ids), **left())
+                r.raise_for_status()
+                return self.decode(r)['data']
+            for found in pool.map(fetch_users, [needed[i:i + 200] for i in range(0, len(needed), 200)]):
+                for u in found:
+                    users[u['id']] = u
+        timings['users'] = time.time() - t
+
+        unread = {}
+        for c in channels:
+            if c.get('has_unread'):
+                unread[c['type']] = unread.get(c['type'], 0) + 1
+        timings['total'] = time.time() - started
+        return {'channels': channels, 'users': users, 'unread': unread, 'timings': timings}
+
+    def iterPages(self, method, *args, **kargs):
+        """api.iterPages(api.getChannelMessage, channel_id, count=200)
+
+Calls a paginated endpoint repeatedly, going back in time with before_id, and
+yields the data of each page until meta.more is false. With with_meta=True it
+yields the whole response body, meta included."""
+        with_meta = kargs.pop('with_meta', False)
+        while True:
+            r = method(*args, **kargs)
+            r.raise_for_status()
+            blob = r.json()
+            yield blob if with_meta else blob['data']
+            meta = blob.get('meta', {})
+            if not meta.get('more') or not blob['data']:
+                return
+            kargs['before_id'] = meta['min_id']
+
+    def exportAccount(self, directory, **opts):
+        """api.exportAccount(directory, columnar=False, workers=4, count=200, **params)
+
+Exports subscribed channels, their messages and the user's files to compressed
+NDJSON in directory, resuming a previous export there. See exporter."""
+        return exporter(self, directory, **opts).run()
+
+    def consumeAppStream(self, handler, stream_id=None, key=None, **opts):
+        """api.consumeAppStream(handler, stream_id=None, key=None, shards=2, workers=None, ...)
+
+Starts consuming an app stream created with createAppStream, and returns the running
+appstreamconsumer. Call its stop() method when done. See appstreamconsumer for the options."""
+        return appstreamconsumer(self, handler, stream_id=stream_id, key=key, **opts).start()
+
+    def config(self, refresh=False):
+        """api.config(refresh=False)
+
+The configuration object from getConfig, fetched once and cached."""
+        if refresh or self._config is None:
+            r = self.getConfig()
+            r.raise_for_status()
+            self._config = r.json()['data']
+        return self._config
+
+    def textProcessor(self):
+        """api.textProcessor()
+
+A textprocessor using the cached configuration object."""
+        return textprocessor(self.config())
+
+    def processTextLocal(self, text, parse_markdown_links=False):
+        """api.processTextLocal(text, parse_markdown_links=False)
+
+Like processText, but computed locally. Returns the decoded body, not a response."""
+        return textprocessor(self._config).process(text, parse_markdown_links)
+
+    # Endpoints that return id lists. With as_idset=True (or api.compact_ids = True) they
+    # return an idset, or a dict of idsets for the endpoints that take several ids.
+    idset_endpoints = ('getFollowerIdsUser', 'getFollowingIdsUser', 'getSubscriberIdsChannel',
+                       'getSubscriberIdListChannel', 'getMutedListUser', 'getBlockedListUser')
+
+    # validate_writes: endpoint name -> kind of object it writes
+    validated = {'createPost': 'post', 'createMessage': 'message'}
+
+    def localFilter(self, filter_id=None, definition=None, refresh=False):
+        """api.localFilter(filter_id=None, definition=None, refresh=False)
+
+Returns a localfilter for a definition, or for a filter on the server. Server filters
+are fetched with getFilter once and cached; pass refresh=True after updateFilter."""
+        if definition is not None:
+            return localfilter(definition)
+        if refresh or filter_id not in self._filters:
+            r = self.getFilter(filter_id)
+            r.raise_for_status()
+            self._filters[filter_id] = localfilter(r.json())
+        return self._filters[filter_id]
+
+    def urlargs(self, e, url):
+        """ The inverse of geturl: the url arguments endpoint e was called with."""
+        rest = url[len(self.base) + len(e['url'][0]):]
+        args = []
+        for i in range(len(e['url_params'])):
+            frag = e['url'][i + 1] if i + 1 < len(e['url']) else ''
+            k = rest.index(frag) if frag else len(rest)
+            args.append(rest[:k])
+            rest = rest[k + len(frag):]
+        return args
+
+    # Request profiles fill in the general_* parameters for every endpoint that takes them,
+    # unless the caller passes the parameter explicitly. Select one with api.profile = "minimal"
+    # or per call with profile="full". A profile can also be a dict of parameters.
+    request_profiles = {
+        "minimal": {'include_annotations': 0, 'include_user_annotations': 0,
+                    'include_post_annotations': 0, 'include_message_annotations': 0,
+                    'include_file_annotations': 0, 'include_html': 0,
+                    'include_starred_by': 0, 'include_reposters': 0,
+                    'include_marker': 0, 'include_recent_message': 0},
+        "full":    {'include_annotations': 1, 'include_user_annotations': 1,
+                    'include_post_annotations': 1, 'include_message_annotations': 1,
+                    'include_file_annotations': 1, 'include_html': 1,
+                    'include_starred_by': 1, 'include_reposters': 1,
+                    'include_marker': 1, 'include_recent_message': 1},
+        }
+
+    def epname(self, ep):
+        """ Name of the api method for endpoint data ep, eg. getUserStreamPost"""
+        return ep['name'] + ep['group'][0].upper() + ep['group'][1:]
+
+    def apply_profile(self, ep_data, params, profile):
+        if not hasattr(profile, 'items'):
+            profile = self.request_profiles[profile]
+        given = params.get('params', {})
+        for cat in ep_data['get_params']:
+            if not cat.startswith('general_'):
+                continue
+            for p in self.parameter_category[cat]:
+                if p in profile and p not in params and p not in given:
+                    params[p] = profile[p]
+
+    def profileSavings(self):
+        """api.profileSavings()
+
+Bytes received per endpoint and profile, compared to calls made without a profile.
+Returns {endpoint: {profile: {'calls', 'bytes', 'avg', 'saved'}}}, where saved is the
+estimated number of bytes the profile saved over all its calls. saved is None until
+the endpoint has also been called without a profile."""
+        ret = {}
+        with self._bytes_lock:
+            stats = dict((name, dict(byprofile)) for name, byprofile in self.byte_stats.items())
+        for name, byprofile in stats.items():
+            base = byprofile.get(None)
+            baseavg = float(base[1]) / base[0] if base else None
+            ret[name] = {}
+            for prof, (calls, nbytes) in byprofile.items():
+                avg = float(nbytes) / calls
+                saved = None if baseavg is None else int((baseavg - avg) * calls)
+                ret[name][prof] = {'calls': calls, 'bytes': nbytes, 'avg': avg, 'saved': saved}
+        return ret
+
+    def _countbytes(self, ep_data, profile, r):
+        content = getattr(r, 'content', None)
+        if content is None:
+            return
+        if profile is not None and hasattr(profile, 'items'):
+            profile = 'custom'
+        with self._bytes_lock:
+            byprofile = self.byte_stats.setdefault(self.epname(ep_data), {})
+            calls, nbytes = byprofile.get(profile, (0, 0))
+            byprofile[profile] = (calls + 1, nbytes + len(content))
+
+    def callopts(self, url, ep_data, params):
+        """ Called by genRequest before it sorts params: takes out the keywords that are for
+apppy rather than the API (as_idset, profile, deadline, priority), fills in the profile
+and validates writes. Returns the options for send()."""
+        opts = {'started': time.time(), 'capture': self.capture}
+        opts['as_idset'] = params.pop('as_idset', self.compact_ids) and self.epname(ep_data) in self.idset_endpoints
+        opts['original'] = dict(params)
+        if self.validate_writes and self.epname(ep_data) in self.validated:
+            self.textProcessor().validate(self.validated[self.epname(ep_data)],
+                                          params.get('text'), params.get('annotations'))
+        opts['lane'] = params.pop('priority', None) or getattr(self._local, 'lane', None)
+        deadline = params.pop('deadline', self.deadline)
+        opts['expires'] = opts['started'] + deadline if deadline is not None else None
+        opts['profile'] = params.pop('profile', self.profile)
+        if opts['profile'] is not None:
+            self.apply_profile(ep_data, params, opts['profile'])
+        return opts
+
+    def send(self, call, url, ep_data, rp, opts):
+        """ Called by genRequest with the request it built. Makes the call (see _send), and
+records it when capturing."""
+        capture = opts['capture']
+        try:
+            r = self._send(call, url, ep_data, rp, opts['lane'], opts['expires'])
+        except Exception as e:
+            if capture is not None:
+                capture.record(self.epname(ep_data), self.urlargs(ep_data, url), opts['original'],
+                               opts['started'], time.time() - opts['started'], error=e)
+            raise
+        if capture is not None:
+            capture.record(self.epname(ep_data), self.urlargs(ep_data, url), opts['original'],
+                           opts['started'], time.time() - opts['started'], r)
+        if not rp.get('stream'):
+            self._countbytes(ep_data, opts['profile'], r)
+        if opts['as_idset']:
+            r.raise_for_status()
+            return idset.load(r.json()['data'])
+        return r
+
+    @staticmethod
+    def _timeout(timeout, left):
+        # the caller's timeout (a number or a (connect, read) tuple), capped by the time left
+        if isinstance(timeout, tuple):
+            return tuple(left if t is None else min(t, left) for t in timeout)
+        return left if timeout is None else min(timeout, left)
+
+    def _send(self, call, url, ep_data, rp, lane=None, expires=None):
+        # Without a retry policy we only repeat the call once, in case of a 429.
+        # With one, idempotent methods are also retried on 5xx errors and dropped
+        # connections, and every host gets a circuit breaker.
+        # With a deadline (expires), every attempt and every wait must fit before it.
+        method = ep_data['method']
+        timeout = rp.get('timeout')
+        policy = self.retry_policy
+        breaker = policy.breaker(urlparse(url).netloc) if policy else None
+        retryable = policy is not None and policy.retryable(method)
+        key = self.ratelimit_key(rp['headers'].get('Authorization', ' ').split(' ', 1)[1])
+        write = method in ("POST", "POST-RAW", "DELETE")
+        started = time.time()
+        attempt = 0
+        capped = False
+        while True:
+            if breaker and not breaker.allow():
+                policy.count('short_circuit_count')
+                raise CircuitOpenError("Circuit open for {0}, failing fast".format(breaker.host))
+            # The lane gate goes first: a shared backend counts the call as soon as it is acquired
+            if self.scheduler is not None:
+                self.scheduler.acquire(self, lane, write, expires, key)
+            try:
+                self.acquire(key, write, expires)
+                if expires is not None:
+                    left = expires - time.time()
+                    if left <= 0:
+                        raise DeadlineExceeded("Deadline passed before calling {0}".format(url))
+                    rp['timeout'] = self._timeout(timeout, left)
+                    capped = rp['timeout'] != timeout
+            except DeadlineExceeded:
+                if self.scheduler is not None:
+                    self.scheduler.release(write)
+                raise
+            try:
+                if self.hedge_policy is not None and method == "GET" and not rp.get('stream'):
+                    r = self._hedged(call, url, ep_data, rp, key, lane, expires)
+                else:
+                    r = call(url, **rp)
+                if 'X-RateLimit-Remaining' in r.headers:
+                    self.setlimit(r, key)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if capped and isinstance(e, requests.exceptions.Timeout):
+                    # Cut short by the caller's deadline rather than its own timeout; that
+                    # says nothing about the host, so the breaker doesn't count it.
+                    raise DeadlineExceeded("Deadline passed calling {0}: {1}".format(url, e))
+                if breaker:
+                    breaker.failure()
+                if expires is not None and time.time() >= expires:
+                    raise DeadlineExceeded("Deadline passed calling {0}: {1}".format(url, e))
+                delay = policy.delay(attempt, started) if retryable else None
+                if delay is None:
+                    if retryable:
+                        policy.count('giveup_count')
+                    raise
+            else:
+                if r.status_code == 429:
+                    # The host answered, so a half-open breaker can close again
+                    if breaker:
+                        breaker.success()
+                    # 429 is "Rate limit exceeded. Need to sleep before you try again"
+                    # http://developers.app.net/docs/basics/rate-limits/
+                    # App.net asks that any client respect 429 and sleep RetryAfter seconds 
+                    # before trying again. In the normal case, we handle the sleeping 
+                    # ourselves. If the caller is clever, they can do api.gimme_429=True 
+                    # in which case it'll raise a 429 error that they're able to catch.
+                    # If they're clever enough to set gimme_429, but not clever enough 
+                    # to catch it, then app.net is still happy.
+                    #
+                    # Without a policy, only do this once. The second time through, just raise
+                    if self.gimme_429:
+                        r.raise_for_status()
+                        return {} # shouldn't get here. This just in case...
+                    retry_after = float(r.headers['RetryAfter'])
+                    if policy:
+                        delay = policy.delay(attempt, started, retry_after)
+                    else:
+                        delay = retry_after if attempt == 0 else None
+                    if delay is None:
+                        if policy:
+                            policy.count('giveup_count')
+                        r.raise_for_status()
+                        return {}
+                elif policy and r.status_code in policy.statuses:
+                    breaker.failure()
+                    delay = policy.delay(attempt, started) if retryable else None
+                    if delay is None:
+                        if retryable:
+                            policy.count('giveup_count')
+                        return r
+                else:
+                    if breaker:
+                        breaker.success()
+                    return r
+            finally:
+                if self.scheduler is not None:
+                    self.scheduler.release(write)
+            if expires is not None and time.time() + delay > expires:
+                raise DeadlineExceeded("Retrying {0} in {1:.1f}s would pass the deadline".format(url, delay))
+            if policy:
+                policy.count('retry_count')
+            self.dprint("retrying {0} {1} in {2:.2f}s".format(method, url, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def _hedged(self, call, url, ep_data, rp, key, lane=None, expires=None):
+        import concurrent.futures
+        hedge = self.hedge_policy
+        name = self.epname(ep_data)
+        started = time.time()
+        delay = hedge.threshold(name)
+        if delay is None:
+            r = call(url, **rp)
+            hedge.observe(name, time.time() - started)
+            return r
+        hedge.count('calls')
+        # The first attempt gets a thread of its own rather than waiting for a pool worker,
+        # so the hedge delay only measures the server. The caller stays free to take
+        # whichever response arrives first.
+        first = concurrent.futures.Future()
+        def attempt():
+            try:
+                first.set_result(call(url, **rp))
+            except Exception as e:
+                first.set_exception(e)
+        t = threading.Thread(target=attempt)
+        t.daemon = True
+        t.start()
+        try:
+            r = first.result(timeout=delay)
+            hedge.observe(name, time.time() - started)
+            return r
+        except concurrent.futures.TimeoutError:
+            pass
+        if not self._hedge(hedge, key, lane, delay, expires):
+            r = first.result()
+            hedge.observe(name, time.time() - started)
+            return r
+        if expires is not None:
+            rp = dict(rp, timeout=self._timeout(rp.get('timeout'), expires - time.time()))
+        second = hedge.submit(call, url, **rp)
+        if self.scheduler is not None:
+            second.add_done_callback(lambda f: self.scheduler.release())
+        pending = set([first, second])
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in sorted(done, key=lambda f: f is second):
+                if f.exception() is None:
+                    if f is second:
+                        hedge.count('won')
+                    hedge.observe(name, time.time() - started)
+                    return f.result()
+                error = f.exception()
+        raise error
+
+    def _hedge(self, hedge, key, lane, delay, expires):
+        # Whether to send a hedge now. It must get through its lane and the shared budget
+        # without waiting, and is pointless when the deadline is closer than delay.
+        if not hedge.allowed(self.budget('global', key)[1]):
+            return False
+        if expires is not None and expires - time.time() < delay:
+            return False
+        if self.scheduler is not None and not self.scheduler.try_acquire(self, lane, key=key):
+            return False
+        try:
+            self.acquire(key, False, time.time())
+        except DeadlineExceeded:
+            if self.scheduler is not None:
+                self.scheduler.release()
+            return False
+        hedge.count('fired')
+        return True
@@ -0,0 +1,439 @@
+""" Things apppy can do locally instead of asking the API: filters, post search
+and text processing."""
+import json
+import re
+import operator
+import bisect
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+from array import array
+
+from apppy_cache import idtype
+
+
+__all__ = ['localfilter', 'postindex', 'ValidationError', 'textprocessor']
+
+
+class localfilter(object):
+    """ A filter definition (as given to createFilter or returned by getFilter) compiled
+into a local predicate. Usage:
+f = localfilter(api.getFilter(filter_id).json())
+f.matches(post)         # True if the filter lets the post through
+f.apply(posts)          # the posts the filter lets through
+
+Objects can be stream events ({"meta":..., "data":...}) or bare objects from an endpoint
+response. Bare objects are treated as messages if they have a channel_id and as posts
+otherwise, unless object_type is given. Clause fields are JSON pointers into the event,
+eg. /data/entities/hashtags/*/name, where * matches every item of a list. A clause only
+matches objects of its object_type.
+
+match_policy is one of include_any, include_all, exclude_any or exclude_all, as on the server.
+"""
+
+    policies = {
+        'include_any': lambda results: any(results),
+        'include_all': lambda results: all(results),
+        'exclude_any': lambda results: not any(results),
+        'exclude_all': lambda results: not all(results),
+        }
+
+    def __init__(self, definition):
+        if 'clauses' not in definition and 'data' in definition:
+            definition = definition['data']
+        self.definition = definition
+        self.policy = self.policies[definition.get('match_policy', 'include_any')]
+        self.clauses = [self.compile_clause(c) for c in definition.get('clauses', [])]
+
+    @staticmethod
+    def _number(v):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def _equals(cls, value):
+        n = cls._number(value)
+        def test(v):
+            if n is not None and not isinstance(v, bool) and cls._number(v) == n:
+                return True
+            return v == value
+        return test
+
+    @classmethod
+    def _compare(cls, value, op):
+        n = cls._number(value)
+        def test(v):
+            m = cls._number(v)
+            if n is not None and m is not None:
+                return op(m, n)
+            return v is not None and op(str(v), str(value))
+        return test
+
+    @classmethod
+    def _one_of(cls, values):
+        tests = [cls._equals(v) for v in values]
+        return lambda v: any(t(v) for t in tests)
+
+    @staticmethod
+    def _matches(value):
+        value = value.lower()
+        return lambda v: hasattr(v, 'lower') and value in v.lower()
+
+    def compile_clause(self, clause):
+        op = clause['operator']
+        value = clause['value']
+        if op == 'equals':
+            test = self._equals(value)
+        elif op == 'matches':
+            test = self._matches(value)
+        elif op == 'one_of':
+            test = self._one_of(value)
+        elif op in ('lt', 'le', 'gt', 'ge'):
+            test = self._compare(value, getattr(operator, op))
+        else:
+            raise ValueError("Unknown filter operator {0}".format(op))
+        path = tuple(p.replace('~1', '/').replace('~0', '~') for p in clause['field'].split('/')[1:])
+        return (clause['object_type'], path, test)
+
+    @classmethod
+    def _values(cls, obj, path):
+        if not path:
+            yield obj
+            return
+        head, rest = path[0], path[1:]
+        if head == '*':
+            if isinstance(obj, list):
+                for item in obj:
+                    for v in cls._values(item, rest):
+                        yield v
+        elif isinstance(obj, dict):
+            if head in obj:
+                for v in cls._values(obj[head], rest):
+                    yield v
+        elif isinstance(obj, list) and head.isdigit() and int(head) < len(obj):
+            for v in cls._values(obj[int(head)], rest):
+                yield v
+
+    def matches(self, obj, object_type=None):
+        if 'meta' in obj and 'data' in obj:
+            event = obj
+            object_type = object_type or obj['meta'].get('type')
+        else:
+            if object_type is None:
+                object_type = 'message' if 'channel_id' in obj else 'post'
+            event = {'meta': {'type': object_type}, 'data': obj}
+        results = []
+        for ctype, path, test in self.clauses:
+            results.append(ctype == object_type and any(test(v) for v in self._values(event, path)))
+        return self.policy(results)
+    __call__ = matches
+
+    def apply(self, objs, object_type=None):
+        return [o for o in objs if self.matches(o, object_type)]
+
+
+class postindex(object):
+    """ In-memory inverted index over posts, searchable with the searchPost parameters.
+Usage:
+idx = postindex()
+idx.ingest(api.getGlobalPost())     # a response, its json, a list of posts or a post
+idx.search(hashtags="appnet", has_attachment=1, order="id", count=20)
+
+Posting lists are sorted arrays of post ids. Ingesting a post again replaces its old
+entry, and deleted posts (is_deleted) are dropped, so the index can follow a stream.
+Supported: query, text, hashtags, links, link_domains, mentions, leading_mentions,
+annotation_types, attachment_types, crosspost_url, crosspost_domain, place_id,
+is_reply, is_directed, has_location, has_checkin, is_crosspost, has_attachment,
+has_oembed_photo, has_oembed_video, has_oembed_html5video, has_oembed_rich, language,
+client_id, creator_id, reply_to, thread_id, plus order (id or score), count,
+since_id and before_id. List parameters are comma separated and all given values
+must match. With store=False only ids are kept and search returns ids.
+"""
+
+    wordre = re.compile(r"\w+", re.UNICODE)
+    listparams = ('hashtags', 'links', 'link_domains', 'mentions', 'leading_mentions',
+                  'annotation_types', 'attachment_types')
+    valueparams = ('crosspost_url', 'crosspost_domain', 'place_id', 'language', 'client_id',
+                   'creator_id', 'reply_to', 'thread_id')
+    flagparams = ('is_reply', 'is_directed', 'has_location', 'has_checkin', 'is_crosspost',
+                  'has_attachment', 'has_oembed_photo', 'has_oembed_video',
+                  'has_oembed_html5video', 'has_oembed_rich')
+
+    def __init__(self, store=True):
+        self.store = store
+        self.postings = {}
+        self.docs = {}
+        self.ids = array(idtype)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, post_id):
+        return self._has(self.ids, int(post_id))
+
+    @staticmethod
+    def _has(arr, i):
+        k = bisect.bisect_left(arr, i)
+        return k < len(arr) and arr[k] == i
+
+    @staticmethod
+    def _add(arr, i):
+        if not arr or arr[-1] < i:
+            arr.append(i)
+        else:
+            k = bisect.bisect_left(arr, i)
+            if k == len(arr) or arr[k] != i:
+                arr.insert(k, i)
+
+    @staticmethod
+    def _remove(arr, i):
+        k = bisect.bisect_left(arr, i)
+        if k < len(arr) and arr[k] == i:
+            arr.pop(k)
+
+    @staticmethod
+    def _domain(url):
+        host = urlparse(url).netloc.lower()
+        return host[4:] if host.startswith('www.') else host
+
+    def terms(self, post):
+        """ The (field, value) terms a post is indexed under."""
+        t = set()
+        for w in self.wordre.findall((post.get('text') or '').lower()):
+            t.add(('text', w))
+        entities = post.get('entities', {})
+        for h in entities.get('hashtags', []):
+            t.add(('hashtags', h['name'].lower()))
+        for m in entities.get('mentions', []):
+            t.add(('mentions', m['name'].lower()))
+            if m.get('is_leading', m.get('pos') == 0):
+                t.add(('leading_mentions', m['name'].lower()))
+                t.add(('is_directed', True))
+        for l in entities.get('links', []):
+            t.add(('links', l['url']))
+            t.add(('link_domains', self._domain(l['url'])))
+        for a in post.get('annotations', []):
+            atype, value = a.get('type'), a.get('value') or {}
+            t.add(('annotation_types', atype))
+            if atype == 'net.app.core.geolocation':
+                t.add(('has_location', True))
+            elif atype == 'net.app.core.checkin':
+                t.add(('has_checkin', True))
+                if value.get('factual_id'):
+                    t.add(('place_id', value['factual_id']))
+            elif atype == 'net.app.core.crosspost':
+                t.add(('is_crosspost', True))
+                if value.get('canonical_url'):
+                    t.add(('crosspost_url', value['canonical_url']))
+                    t.add(('crosspost_domain', self._domain(value['canonical_url'])))
+            elif atype == 'net.app.core.language' and value.get('language'):
+                t.add(('language', value['language']))
+            elif atype in ('net.app.core.attachments', 'net.app.core.file_list'):
+                t.add(('has_attachment', True))
+                for f in value.get('net.app.core.file_list', []) if atype == 'net.app.core.attachments' else [value]:
+                    if f.get('kind'):
+                        t.add(('attachment_types', f['kind']))
+            elif atype == 'net.app.core.oembed':
+                t.add(('has_oembed_' + str(value.get('type')), True))
+        if post.get('reply_to'):
+            t.add(('is_reply', True))
+            t.add(('reply_to', str(post['reply_to'])))
+        if post.get('thread_id'):
+            t.add(('thread_id', str(post['thread_id'])))
+        if post.get('user'):
+            t.add(('creator_id', str(post['user']['id'])))
+        if post.get('source', {}).get('client_id'):
+            t.add(('client_id', post['source']['client_id']))
+        return t
+
+    def ingest(self, posts):
+        """ Adds posts to the index. Returns the number of posts ingested."""
+        if hasattr(posts, 'json'):
+            posts = posts.json()
+        if isinstance(posts, dict):
+            posts = posts['data'] if 'data' in posts else [posts]
+            if isinstance(posts, dict):
+                posts = [posts]
+        n = 0
+        for post in posts:
+            self.remove(post['id'])
+            if post.get('is_deleted'):
+                continue
+            i = int(post['id'])
+            for term in self.terms(post):
+                self._add(self.postings.setdefault(term, array(idtype)), i)
+            self._add(self.ids, i)
+            self.docs[i] = post if self.store else None
+            n += 1
+        return n
+
+    def remove(self, post_id):
+        i = int(post_id)
+        if i not in self.docs:
+            return
+        post = self.docs.pop(i)
+        self._remove(self.ids, i)
+        for term in (self.terms(post) if post is not None else list(self.postings)):
+            arr = self.postings.get(term)
+            if arr is not None:
+                self._remove(arr, i)
+                if not arr:
+                    del self.postings[term]
+
+    @staticmethod
+    def _flag(v):
+        return str(v).lower() not in ('0', 'false', '')
+
+    def _criteria(self, params):
+        include, exclude = [], []
+        for p in ('query', 'text'):
+            if params.get(p):
+                include += [('text', w) for w in self.wordre.findall(params[p].lower())]
+        for p in self.listparams:
+            if params.get(p):
+                values = params[p].split(',') if hasattr(params[p], 'split') else params[p]
+                for v in values:
+                    v = v.strip()
+                    if p in ('hashtags', 'mentions', 'leading_mentions'):
+                        v = v.lstrip('#@').lower()
+                    elif p == 'link_domains':
+                        v = v.lower()
+                    include.append((p, v))
+        for p in self.valueparams:
+            if params.get(p) is not None:
+                include.append((p, str(params[p])))
+        for p in self.flagparams:
+            if params.get(p) is not None:
+                (include if self._flag(params[p]) else exclude).append((p, True))
+        return include, exclude
+
+    def search(self, **params):
+        include, exclude = self._criteria(params)
+        inc = sorted((self.postings.get(term, array(idtype)) for term in include), key=len)
+        exc = [self.postings[term] for term in exclude if term in self.postings]
+        # walk the shortest posting list, probe the others
+        candidates = inc.pop(0) if inc else self.ids
+        before = int(params['before_id']) if params.get('before_id') else None
+        since = int(params['since_id']) if params.get('since_id') else None
+        hits = []
+        for i in candidates:
+            if (before is not None and i >= before) or (since is not None and i <= since):
+                continue
+            if all(self._has(arr, i) for arr in inc) and not any(self._has(arr, i) for arr in exc):
+                hits.append(i)
+        if params.get('order') == 'score' and self.store:
+            words = [w for f, w in include if f == 'text']
+            def score(i):
+                text = self.wordre.findall((self.docs[i].get('text') or '').lower())
+                return (sum(text.count(w) for w in words), i)
+            hits.sort(key=score, reverse=True)
+        else:
+            hits.reverse()
+        hits = hits[:int(params.get('count', 20))]
+        if self.store:
+            return [self.docs[i] for i in hits]
+        return [str(i) for i in hits]
+
+
+class ValidationError(ValueError):
+    """ Raised when a post or message would be rejected by the API."""
+
+
+class textprocessor(object):
+    """ Local stand-in for processText, with limits taken from the configuration object.
+Usage:
+tp = textprocessor(api.getConfig().json()['data'])    # or api.textProcessor()
+tp.process("hi @dalton #appnet http://app.net")      # same shape as processText().json()
+tp.validate("post", text, annotations)               # raises ValidationError
+
+Mentions, hashtags and links get name/text, pos and len in characters, like the API.
+With parse_markdown_links=True, [text](url) is replaced by text and becomes a link.
+Text lengths count every {post_id} or {message_id} uri template at the length the
+configuration gives it, and annotations are measured as compact JSON.
+"""
+
+    mentionre = re.compile(r"(?<![\w@])@([A-Za-z0-9_]+)", re.UNICODE)
+    hashtagre = re.compile(r"(?<![\w#&])#(\w*[^\W\d_]\w*)", re.UNICODE)
+    linkre = re.compile(r"\bhttps?://[^\s<>\"]+", re.UNICODE)
+    markdownre = re.compile(r"\[([^\]]+)\]\((https?://[^\s)]+)\)", re.UNICODE)
+    templatere = re.compile(r"\{(post_id|message_id)\}")
+    trailing = ".,;:!?'\")]}"
+
+    def __init__(self, config=None):
+        self.config = config or {}
+
+    def process(self, text, parse_markdown_links=False):
+        links = []
+        if parse_markdown_links:
+            out, last = [], 0
+            for m in self.markdownre.finditer(text):
+                out.append(text[last:m.start()])
+                pos = sum(len(p) for p in out)
+                links.append({'text': m.group(1), 'url': m.group(2), 'pos': pos,
+                              'len': len(m.group(1)), 'amended_len': len(m.group(0))})
+                out.append(m.group(1))
+                last = m.end()
+            text = "".join(out) + text[last:]
+        taken = [(l['pos'], l['pos'] + l['len']) for l in links]
+        def free(a, b):
+            return all(b <= x or a >= y for x, y in taken)
+        for m in self.linkre.finditer(text):
+            url = m.group(0).rstrip(self.trailing)
+            if free(m.start(), m.start() + len(url)):
+                links.append({'text': url, 'url': url, 'pos': m.start(), 'len': len(url)})
+                taken.append((m.start(), m.start() + len(url)))
+        mentions = [{'name': m.group(1), 'pos': m.start(), 'len': m.end() - m.start()}
+                    for m in self.mentionre.finditer(text) if free(m.start(), m.end())]
+        hashtags = [{'name': m.group(1), 'pos': m.start(), 'len': m.end() - m.start()}
+                    for m in self.hashtagre.finditer(text) if free(m.start(), m.end())]
+        links.sort(key=lambda l: l['pos'])
+        entities = {'mentions': mentions, 'hashtags': hashtags, 'links': links}
+        return {'data': {'text': text, 'html': self.html(text, entities), 'entities': entities}}
+
+    @staticmethod
+    def _escape(t):
+        return t.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+    def html(self, text, entities):
+        spans = []
+        for m in entities['mentions']:
+            spans.append((m['pos'], m['len'], '<span data-mention-name="{0}" itemprop="mention">{1}</span>'))
+        for h in entities['hashtags']:
+            spans.append((h['pos'], h['len'], '<span data-hashtag-name="{0}" itemprop="hashtag">{1}</span>'))
+        for l in entities['links']:
+            spans.append((l['pos'], l['len'], '<a href="' + self._escape(l['url']) + '">{1}</a>'))
+        spans.sort()
+        out, last = [], 0
+        for pos, length, fmt in spans:
+            piece = text[pos:pos + length]
+            out.append(self._escape(text[last:pos]))
+            out.append(fmt.format(self._escape(piece.lstrip('@#')), self._escape(piece)))
+            last = pos + length
+        out.append(self._escape(text[last:]))
+        return '<span itemscope="https://app.net/schemas/Post">' + "".join(out) + '</span>'
+
+    def length(self, text):
+        sizes = self.config.get('text', {}).get('uri_template_length', {})
+        n = len(text)
+        for m in self.templatere.finditer(text):
+            if m.group(1) in sizes:
+                n += sizes[m.group(1)] - len(m.group(0))
+        return n
+
+    def validate(self, kind, text=None, annotations=None):
+        """ Checks text and annotations of a post, message, ... against the configuration."""
+        limits = self.config.get(kind, {})
+        if text is not None and 'text_max_length' in limits:
+            n = self.length(text)
+            if n > limits['text_max_length']:
+                raise ValidationError("{0} text is {1} characters, the limit is {2}".format(
+                    kind, n, limits['text_max_length']))
+        if annotations is not None and 'annotation_max_bytes' in limits:
+            n = len(json.dumps(annotations, separators=(',', ':')).encode('utf-8'))
+            if n > limits['annotation_max_bytes']:
+                raise ValidationError("{0} annotations are {1} bytes, the limit is {2}".format(
+                    kind, n, limits['annotation_max_bytes']))
@@ -0,0 +1,405 @@
+""" Consumers for app streams and user streams."""
+import requests
+import json
+import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+__all__ = ['appstreamconsumer', 'unreadtracker']
+
+
+class appstreamconsumer(object):
+    """ Consumes an app stream over several sharded connections.
+Usage: appstreamconsumer(api, handler, stream_id=None, key=None, endpoint=None, shards=2, ...)
+
+All shards connect to the same stream endpoint, so App.net splits the events between
+them. Each shard decodes its own frames and routes every event by object id to one of
+the partitions. A partition hands its events to the pool one at a time, so events for
+the same object id are handled in order while different objects are handled in parallel.
+
+handler(event) is called with each decoded event ({"meta":..., "data":...}). With
+processes=True (the default) it runs in a process pool and must be picklable, ie. a
+module level function. on_result(event, result) and on_error(event, exc) are optional
+callbacks run in this process.
+
+Queues are bounded by queue_size; when handlers fall behind, the shards stop reading
+and the backpressure goes to the server.
+Metrics: stats() returns events, bytes, errors, reconnects, throughput (events/s),
+lag and max_lag (seconds between the event timestamp and the end of its handler) and
+the current queue depths.
+"""
+
+    chunk_size = 65536
+
+    def __init__(self, api, handler, stream_id=None, key=None, endpoint=None, shards=2,
+                 workers=None, partitions=None, queue_size=1000, processes=True,
+                 on_result=None, on_error=None, timeout=90):
+        self.api = api
+        self.handler = handler
+        self.stream_id = stream_id
+        self.key = key
+        self.endpoint = endpoint
+        self.shards = shards
+        self.workers = workers
+        self.partitions = partitions
+        self.queue_size = queue_size
+        self.processes = processes
+        self.on_result = on_result
+        self.on_error = on_error
+        self.timeout = timeout
+        self.events = 0
+        self.bytes = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.lag = None
+        self.max_lag = 0
+        self.started = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._responses = {}    # shard -> its current response
+        self._queues = []
+        self._pool = None
+
+    def resolve_endpoint(self):
+        if self.endpoint:
+            return self.endpoint
+        if self.stream_id:
+            stream = self.api.getAppStream(self.stream_id).json()['data']
+        else:
+            streams = self.api.getAllAppStream().json()['data']
+            streams = [st for st in streams if self.key is None or st.get('key') == self.key]
+            if not streams:
+                raise ValueError("No app stream with key {0}".format(self.key))
+            stream = streams[0]
+        self.endpoint = stream['endpoint']
+        return self.endpoint
+
+    def start(self):
+        import concurrent.futures
+        self.resolve_endpoint()
+        workers = self.workers or self.shards * 2
+        if self.processes:
+            self._pool = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self._queues = [queue.Queue(self.queue_size) for i in range(self.partitions or workers)]
+        self.started = time.time()
+        for q in self._queues:
+            self._spawn(self._dispatch, q)
+        for i in range(self.shards):
+            self._spawn(self._read, i)
+        return self
+
+    def _spawn(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def stop(self, wait=True):
+        self._stop.set()
+        for r in list(self._responses.values()):
+            try:
+                r.close()
+            except Exception:
+                pass
+        for q in self._queues:
+            q.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+        if self._pool:
+            self._pool.shutdown(wait)
+
+    def _read(self, shard):
+        h = {}
+        if self.api.app_access_token:
+            h['Authorization'] = "Bearer " + self.api.app_access_token
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                r = requests.get(self.endpoint, stream=True, headers=h, timeout=self.timeout)
+                r.raise_for_status()
+                old, self._responses[shard] = self._responses.get(shard), r
+                if old is not None:
+                    old.close()
+                delay = 1
+                # chunked responses are passed on as each chunk arrives, whatever chunk_size is
+                for line in r.iter_lines(chunk_size=self.chunk_size):
+                    if self._stop.is_set():
+                        return
+                    if not line:
+                        continue # heartbeat
+                    self._route(line)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.api.dprint("app stream shard {0}: {1}".format(shard, e))
+            if self._stop.is_set():
+                return
+            with self._lock:
+                self.reconnects += 1
+            self._stop.wait(delay)
+            delay = min(delay * 2, 30)
+
+    def _route(self, line):
+        if not hasattr(line, 'encode'):
+            line = line.decode('utf-8')
+        event = json.loads(line)
+        meta = event.get('meta', {})
+        oid = meta.get('id') or (event.get('data') or {}).get('id')
+        q = self._queues[hash(oid) % len(self._queues)]
+        with self._lock:
+            self.bytes += len(line)
+        q.put(event)
+
+    def _dispatch(self, q):
+        while True:
+            event = q.get()
+            if event is None:
+                return
+            try:
+                result = self._pool.submit(self.handler, event).result()
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                if self.on_error:
+                    self.on_error(event, e)
+                continue
+            ts = event.get('meta', {}).get('timestamp')
+            with self._lock:
+                self.events += 1
+                if ts:
+                    self.lag = time.time() - ts / 1000.0
+                    self.max_lag = max(self.max_lag, self.lag)
+            if self.on_result:
+                self.on_result(event, result)
+
+    def stats(self):
+        elapsed = time.time() - self.started if self.started else 0
+        with self._lock:
+            return {'events': self.events, 'bytes': self.bytes, 'errors': self.errors,
+                    'reconnects': self.reconnects, 'lag': self.lag, 'max_lag': self.max_lag,
+                    'throughput': self.events / elapsed if elapsed else 0.0,
+                    'queued': [q.qsize() for q in self._queues]}
+
+
+class unreadtracker(object):
+    """ Keeps unread counts for subscribed channels up to date from a user stream,
+instead of polling getUnreadCountChannel / getUnreadBroadcastCountChannel.
+Usage:
+tracker = unreadtracker(api).start()    # seed once, then follow a user stream
+tracker.count(channel_id)               # unread messages seen in a channel
+tracker.total()                         # number of unread channels, like num_unread
+tracker.total('net.app.core.broadcast')
+
+Counts are seeded once from getUserSubscribedChannel (include_read, include_marker)
+and then updated from channel, message and stream_marker events. A channel that is
+unread when seeded counts as 1 until more messages arrive. A message for an unknown
+channel fetches just that channel. When the stream drops, the tracker polls the
+num_unread endpoints on reconnect and only rescans the channels if they disagree.
+All lookups are O(1). polls and rescans count how often it had to go to the API.
+"""
+
+    channel_types = ('net.app.core.pm', 'net.app.core.broadcast')
+    chunk_size = 65536
+
+    def __init__(self, api, channel_types=None, me=None):
+        self.api = api
+        if channel_types is not None:
+            self.channel_types = channel_types
+        self.me = me
+        self.counts = {}
+        self.types = {}
+        self.last_read = {}
+        self.latest = {}
+        self.ignored = set()
+        self.totals = dict((t, 0) for t in self.channel_types)
+        self.unread_messages = 0
+        self.polls = 0
+        self.rescans = 0
+        self.connection_id = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._stream = None
+
+    def count(self, channel_id):
+        return self.counts.get(str(channel_id), 0)
+
+    def total(self, channel_type=None):
+        if channel_type is None:
+            return sum(self.totals.values())
+        return self.totals.get(channel_type, 0)
+
+    def _set(self, ch, n):
+        old = self.counts.get(ch, 0)
+        self.counts[ch] = n
+        self.unread_messages += n - old
+        t = self.types[ch]
+        if t in self.totals and bool(old) != bool(n):
+            self.totals[t] += 1 if n else -1
+
+    def _drop(self, ch):
+        if ch in self.types:
+            self._set(ch, 0)
+            for d in (self.counts, self.types, self.last_read, self.latest):
+                d.pop(ch, None)
+
+    def channel(self, channel):
+        """ Updates the state of a channel from a channel object."""
+        with self._lock:
+            ch = channel['id']
+            if channel.get('type') not in self.channel_types:
+                self.ignored.add(ch)
+                return
+            self.types[ch] = channel['type']
+            marker = channel.get('marker') or {}
+            if marker.get('last_read_id') or marker.get('id'):
+                self.last_read[ch] = int(marker.get('last_read_id') or marker['id'])
+            if channel.get('recent_message_id'):
+                self.latest[ch] = max(self.latest.get(ch, 0), int(channel['recent_message_id']))
+            if channel.get('has_unread'):
+                self._set(ch, max(self.counts.get(ch, 0), 1))
+            elif 'has_unread' in channel:
+                self._set(ch, 0)
+            else:
+                self._set(ch, self.counts.get(ch, 0))
+
+    def message(self, message, deleted=False):
+        with self._lock:
+            ch = message['channel_id']
+            if ch in self.ignored:
+                return
+            if ch not in self.types:
+                # New channel, or one we missed. Fetch it rather than guess its type.
+                self.polls += 1
+                r = self.api.getChannel(ch, include_read=1, include_marker=1)
+                if r.status_code != 200:
+                    return
+                self.channel(r.json()['data'])
+                if ch not in self.types:
+                    return
+            mid = int(message['id'])
+            unread = mid > self.last_read.get(ch, 0)
+            if deleted:
+                if unread and self.counts.get(ch):
+                    self._set(ch, self.counts[ch] - 1)
+            elif self.me is not None and message.get('user', {}).get('id') == self.me:
+                # Writing to a channel moves your own read marker
+                self.last_read[ch] = max(self.last_read.get(ch, 0), mid)
+                self._set(ch, 0)
+            elif unread and mid > self.latest.get(ch, 0):
+                self._set(ch, self.counts.get(ch, 0) + 1)
+            self.latest[ch] = max(self.latest.get(ch, 0), mid)
+
+    def marker(self, marker):
+        name = marker.get('name', '')
+        if not name.startswith('channel:'):
+            return
+        with self._lock:
+            ch = name[len('channel:'):]
+            if ch not in self.types:
+                return
+            self.last_read[ch] = int(marker.get('last_read_id') or marker['id'])
+            if self.last_read[ch] >= self.latest.get(ch, 0):
+                self._set(ch, 0)
+
+    def feed(self, event):
+        """ Applies one decoded user stream event."""
+        meta, data = event.get('meta', {}), event.get('data')
+        etype = meta.get('type')
+        if etype == 'channel':
+            if meta.get('is_deleted'):
+                with self._lock:
+                    self._drop(meta.get('id') or data['id'])
+            else:
+                with self._lock:
+                    # Count recent_message before channel() moves latest past it. A channel
+                    # we don't know yet is seeded from its has_unread instead.
+                    if data.get('recent_message') and data['id'] in self.types:
+                        self.message(data['recent_message'])
+                    self.channel(data)
+        elif etype == 'message':
+            self.message(data, deleted=meta.get('is_deleted', False))
+        elif etype == 'stream_marker':
+            self.marker(data)
+
+    def seed(self):
+        with self._lock:
+            if self.me is None:
+                self.me = self.api.getUser("me").json()['data']['id']
+            for ch in list(self.types):
+                self._drop(ch)
+            for page in self.api.iterPages(self.api.getUserSubscribedChannel,
+                                           channel_types=",".join(self.channel_types),
+                                           include_read=1, include_marker=1, count=200):
+                for channel in page:
+                    self.channel(channel)
+        return self
+
+    def gap(self):
+        """ Called when events may have been missed. Polls num_unread, rescans if needed."""
+        polled = {'net.app.core.pm': self.api.getUnreadCountChannel,
+                  'net.app.core.broadcast': self.api.getUnreadBroadcastCountChannel}
+        for t in self.channel_types:
+            if t not in polled:
+                self.rescans += 1
+                return self.seed()
+            self.polls += 1
+            if polled[t]().json()['data'] != self.totals[t]:
+                self.rescans += 1
+                return self.seed()
+        return self
+
+    def subscribe(self, connection_id, channels=()):
+        """ Subscribes a user stream to channel updates and markers, plus the messages of
+the given channels. Without channel message subscriptions, new messages are picked up
+from the recent_message of channel updates."""
+        self.connection_id = connection_id
+        self.api.getUserSubscribedChannel(connection_id=connection_id,
+                                          channel_types=",".join(self.channel_types),
+                                          include_read=1, include_marker=1,
+                                          include_recent_message=1)
+        for ch in channels:
+            self.api.getChannelMessage(ch, connection_id=connection_id)
+
+    def follow(self, stream):
+        """ Feeds the events of a createUserStream response into the tracker until it ends."""
+        for line in stream.iter_lines(chunk_size=self.chunk_size):
+            if self._stop.is_set():
+                return
+            if line:
+                if not hasattr(line, 'encode'):
+                    line = line.decode('utf-8')
+                self.feed(json.loads(line))
+
+    def run(self, channels=()):
+        seeded = False
+        while not self._stop.is_set():
+            try:
+                self._stream = self.api.createUserStream(timeout=90)
+                self.subscribe(self._stream.headers['Connection-Id'], channels)
+                if seeded:
+                    self.gap()
+                else:
+                    self.seed()
+                    seeded = True
+                self.follow(self._stream)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.api.dprint("unread tracker: {0}".format(e))
+            self._stop.wait(1)
+
+    def start(self, channels=()):
+        t = threading.Thread(target=self.run, args=(channels,))
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._stream is not None:
+            self._stream.close()
@@ -0,0 +1,376 @@
+""" Account export, traffic capture and replay, and coalesced writes for apppy."""
+import requests
+import json
+import time
+import os
+import gzip
+import calendar
+import threading
+import atexit
+import weakref
+
+from array import array
+from collections import OrderedDict
+
+from apppy_cache import idtype
+
+
+__all__ = ['exporter', 'trafficlog', 'replayer', 'coalescingwriter']
+
+
+class exporter(object):
+    """ Streams an account's subscribed channels, their messages and the user's files to
+gzipped newline-delimited JSON in directory:
+channels.ndjson.gz, files.ndjson.gz, messages/<channel_id>.ndjson.gz
+Usage: exporter(api, directory, columnar=False, workers=4, count=200, **params).run()
+
+Every page is written as soon as it arrives, so memory is bounded by one page per
+worker. Channels' messages are downloaded in parallel by workers threads. Progress is
+kept in state.json after every page: an interrupted export resumes where it stopped,
+and a finished one only fetches what is newer the next time it runs. A page may be
+written twice if the process dies between writing it and saving the state.
+
+With columnar=True numeric fields are also appended to raw native int64 files next to
+the NDJSON, eg. messages/<channel_id>.id.i64 and .created_at.i64 (epoch seconds), which
+load with array('q').fromfile or numpy.fromfile.
+params (eg. include_annotations=1) are passed to every endpoint call.
+"""
+
+    columns = {'channels': ('id', 'owner.id'),
+               'messages': ('id', 'user.id', 'created_at'),
+               'files': ('id', 'user.id', 'size', 'created_at')}
+
+    def __init__(self, api, directory, columnar=False, workers=4, count=200, **params):
+        self.api = api
+        self.directory = directory
+        self.columnar = columnar
+        self.workers = workers
+        self.count = count
+        self.params = params
+        self.exported = {}
+        self._lock = threading.Lock()
+        self.statefile = os.path.join(directory, 'state.json')
+        if os.path.exists(self.statefile):
+            with open(self.statefile) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {}
+
+    def _savestate(self):
+        tmp = self.statefile + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp, self.statefile)
+
+    @staticmethod
+    def _field(obj, path):
+        for p in path.split('.'):
+            obj = obj.get(p) if obj else None
+        if obj is None:
+            return 0
+        if path == 'created_at':
+            return calendar.timegm(time.strptime(obj, "%Y-%m-%dT%H:%M:%SZ"))
+        return int(obj)
+
+    def _write(self, name, kind, items, mode='ab'):
+        path = os.path.join(self.directory, name)
+        with gzip.open(path + '.ndjson.gz', mode) as f:
+            for item in items:
+                f.write((json.dumps(item, separators=(',', ':')) + "\n").encode('utf-8'))
+        if self.columnar:
+            for col in self.columns[kind]:
+                with open("{0}.{1}.i64".format(path, col.replace('.', '_')), mode) as f:
+                    array(idtype, [self._field(item, col) for item in items]).tofile(f)
+        with self._lock:
+            self.exported[kind] = self.exported.get(kind, 0) + len(items)
+
+    def _stream(self, name, kind, method, *args):
+        """ Exports one paginated stream, resuming from state."""
+        with self._lock:
+            st = self.state.setdefault(name, {'max_id': None, 'cursor': None, 'top': None})
+        kargs = dict(self.params, count=self.count)
+        if st['max_id']:
+            kargs['since_id'] = st['max_id']
+        if st['cursor']:
+            kargs['before_id'] = st['cursor']
+        for blob in self.api.iterPages(method, *args, with_meta=True, **kargs):
+            if blob['data']:
+                self._write(name, kind, blob['data'])
+                meta = blob['meta']
+                with self._lock:
+                    st['cursor'] = meta['min_id']
+                    if st['top'] is None or int(meta['max_id']) > int(st['top']):
+                        st['top'] = meta['max_id']
+                    self._savestate()
+        with self._lock:
+            st['max_id'], st['cursor'], st['top'] = st['top'] or st['max_id'], None, None
+            self._savestate()
+
+    def run(self):
+        import concurrent.futures
+        if not os.path.isdir(os.path.join(self.directory, 'messages')):
+            os.makedirs(os.path.join(self.directory, 'messages'))
+        # The channel list is ordered by activity, not id, so it is rewritten every run.
+        channels = []
+        mode = 'wb'
+        for page in self.api.iterPages(self.api.getUserSubscribedChannel, count=self.count, **self.params):
+            self._write('channels', 'channels', page, mode)
+            channels += [c['id'] for c in page]
+            mode = 'ab'
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            jobs = [pool.submit(self._stream, 'files', 'files', self.api.getUserFile)]
+            jobs += [pool.submit(self._stream, 'messages/' + ch, 'messages', self.api.getChannelMessage, ch)
+                     for ch in channels]
+            for job in jobs:
+                job.result()
+        return self.exported
+
+
+class trafficlog(object):
+    """ Records every call made through genRequest to a gzipped NDJSON log, for replayer.
+Usage: api.capture = trafficlog(path, responses=True)
+
+Each line holds the endpoint name, its url arguments and keyword parameters, the
+start time relative to the first call, the elapsed time, the status and (with
+responses=True) the response body. Headers and the parameters in secret_params
+are never written, nor are the bodies of token endpoints. Call close() when done.
+"""
+
+    secret_params = ('headers', 'access_token', 'client_secret', 'code', 'password')
+
+    def __init__(self, path, responses=True):
+        self.path = path
+        self.responses = responses
+        self.started = None
+        self.calls = 0
+        self._f = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+
+    def record(self, ep, args, params, started, elapsed, r=None, error=None):
+        rec = {'endpoint': ep, 'args': args, 'elapsed': elapsed,
+               'params': dict((k, v) for k, v in params.items() if k not in self.secret_params)}
+        if r is not None:
+            rec['status'] = getattr(r, 'status_code', None)
+            if self.responses and not ep.endswith('Token') and not params.get('stream'):
+                rec['body'] = getattr(r, 'text', None)
+        if error is not None:
+            rec['error'] = repr(error)
+        with self._lock:
+            if self.started is None:
+                self.started = started
+            rec['t'] = started - self.started
+            self._f.write((json.dumps(rec, default=repr, separators=(',', ':')) + "\n").encode('utf-8'))
+            self.calls += 1
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+class replayer(object):
+    """ Replays a trafficlog through an apppy client.
+Usage: replayer(path).run(api, speed=1.0, concurrency=1)
+
+Calls are made in their recorded order and, scaled by speed, at their recorded
+offsets (speed=10 replays ten times faster, speed=None as fast as possible). With
+concurrency > 1 calls are issued from that many threads, so slow calls don't delay
+the ones after them. Returns a report with the number of calls, errors, status codes,
+throughput and latency percentiles, overall and per endpoint.
+"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def records(self):
+        with gzip.open(self.path, 'rb') as f:
+            for line in f:
+                yield json.loads(line.decode('utf-8'))
+
+    @staticmethod
+    def _percentiles(latencies):
+        latencies = sorted(latencies)
+        if not latencies:
+            return {}
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+        return {'p50': pct(50), 'p90': pct(90), 'p99': pct(99), 'max': latencies[-1],
+                'mean': sum(latencies) / len(latencies)}
+
+    def run(self, api, speed=1.0, concurrency=1):
+        import concurrent.futures
+        results = []
+        lock = threading.Lock()
+
+        def call(rec):
+            t = time.time()
+            try:
+                r = getattr(api, rec['endpoint'])(*rec['args'], **rec['params'])
+                status = getattr(r, 'status_code', None)
+            except Exception as e:
+                status = type(e).__name__
+            with lock:
+                results.append((rec['endpoint'], status, time.time() - t))
+
+        started = time.time()
+        pool = concurrent.futures.ThreadPoolExecutor(concurrency) if concurrency > 1 else None
+        for rec in self.records():
+            if speed:
+                wait = started + rec['t'] / speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            if pool:
+                pool.submit(call, rec)
+            else:
+                call(rec)
+        if pool:
+            pool.shutdown(True)
+        elapsed = time.time() - started
+
+        report = {'calls': len(results), 'elapsed': elapsed, 'status': {}, 'endpoints': {},
+                  'throughput': len(results) / elapsed if elapsed else 0.0,
+                  'errors': len([1 for e, st, l in results if not isinstance(st, int) or st >= 400])}
+        for ep, st, l in results:
+            report['status'][st] = report['status'].get(st, 0) + 1
+            report['endpoints'].setdefault(ep, []).append(l)
+        report['latency'] = self._percentiles([l for e, st, l in results])
+        for ep in report['endpoints']:
+            lat = report['endpoints'][ep]
+            report['endpoints'][ep] = dict(self._percentiles(lat), calls=len(lat))
+        return report
+
+
+class coalescingwriter(object):
+    """ Buffers idempotent writes and sends only the latest value per key.
+Usage:
+writer = coalescingwriter(api, interval=2.0)
+writer.updateMarker(name="global", id=post_id)          # per marker name
+writer.partialUpdateUser(description={"text": "..."})    # per field, merged
+writer.markBroadcastChannelsReadChannel()
+writer.close()                                           # or at interpreter exit
+
+Writes are sent interval seconds after the first buffered one, or on flush()/close().
+All pending markers go out in one updateMarker call. A write that fails is kept for
+the next flush unless a newer value replaced it. stats() reports submitted writes, the
+values actually written, the API calls made, and absorbed: the writes that did not
+need an API call of their own.
+"""
+
+    _open = weakref.WeakSet()   # writers to close at interpreter exit
+
+    def __init__(self, api, interval=2.0):
+        self.api = api
+        self.interval = interval
+        self.markers = OrderedDict()
+        self.user = {}
+        self.broadcast_read = False
+        self.submitted = 0
+        self.written = 0
+        self.calls = 0
+        self.errors = 0
+        self._timer = None
+        self._lock = threading.RLock()
+        self._flushing = threading.Lock()   # one flush at a time, so older values can't land last
+        coalescingwriter._open.add(self)
+
+    def _pending(self):
+        # called with the lock held
+        self.submitted += 1
+        if self._timer is None and self.interval is not None:
+            self._timer = threading.Timer(self.interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def updateMarker(self, **marker):
+        with self._lock:
+            self.markers.pop(marker['name'], None)
+            self.markers[marker['name']] = marker
+            self._pending()
+
+    @classmethod
+    def _merge(cls, into, fields):
+        for k, v in fields.items():
+            if isinstance(v, dict) and isinstance(into.get(k), dict):
+                cls._merge(into[k], v)
+            else:
+                into[k] = v
+
+    def partialUpdateUser(self, **fields):
+        with self._lock:
+            self._merge(self.user, fields)
+            self._pending()
+
+    def markBroadcastChannelsReadChannel(self):
+        with self._lock:
+            self.broadcast_read = True
+            self._pending()
+
+    def _write(self, method, *args, **kargs):
+        try:
+            r = method(*args, **kargs)
+            self.calls += 1
+            r.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            self.errors += 1
+            self.api.dprint("coalesced {0} failed: {1}".format(method.__name__, e))
+            return False
+
+    def flush(self):
+        with self._flushing:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            markers, self.markers = self.markers, OrderedDict()
+            user, self.user = self.user, {}
+            broadcast_read, self.broadcast_read = self.broadcast_read, False
+        if markers:
+            values = list(markers.values())
+            if len(values) == 1:
+                ok = self._write(self.api.updateMarker, **values[0])
+            else:
+                ok = self._write(self.api.updateMarker, data=values)
+            def requeue():
+                for name, marker in markers.items():
+                    self.markers.setdefault(name, marker)
+            self._done(ok, len(values), requeue)
+        if user:
+            ok = self._write(self.api.partialUpdateUser, **user)
+            def requeue():
+                newer, self.user = self.user, user
+                self._merge(self.user, newer)
+            self._done(ok, len(user), requeue)
+        if broadcast_read:
+            ok = self._write(self.api.markBroadcastChannelsReadChannel)
+            self._done(ok, 1, lambda: setattr(self, 'broadcast_read', True))
+
+    def _done(self, ok, n, requeue):
+        with self._lock:
+            if ok:
+                self.written += n
+            else:
+                requeue()
+                if self._timer is None and self.interval is not None:
+                    self._timer = threading.Timer(self.interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+    def close(self):
+        self.interval = None
+        self.flush()
+        coalescingwriter._open.discard(self)
+
+    @classmethod
+    def _closeall(cls):
+        for writer in list(cls._open):
+            writer.close()
+
+    def stats(self):
+        with self._lock:
+            return {'submitted': self.submitted, 'written': self.written, 'calls': self.calls,
+                    'errors': self.errors, 'absorbed': self.submitted - self.calls}
+
+atexit.register(coalescingwriter._closeall)
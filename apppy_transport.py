@@ -0,0 +1,399 @@
+""" Retries, circuit breakers, shared rate limits, hedging and priority lanes for apppy.
+Assign them to api.retry_policy, api.ratelimit_backend, api.hedge_policy and api.scheduler."""
+import requests
+import json
+import time
+import random
+import threading
+import contextlib
+
+from collections import OrderedDict, deque
+
+
+__all__ = ['CircuitOpenError', 'DeadlineExceeded', 'ratelimitstate', 'fileratelimit',
+           'circuitbreaker', 'retrypolicy', 'hedgepolicy', 'priorityscheduler']
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Raised instead of calling a host whose circuit breaker is open."""
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """ Raised when a call can't finish within its deadline, including the time it
+would spend retrying or waiting for the rate limit."""
+
+
+class ratelimitstate(object):
+    """ Rate limit budgets shared by every client given the same object (threads in one
+process). Budgets are kept per token key and kind ('global' or 'write'), seeded from
+the X-RateLimit headers of responses and decremented locally by every call, so
+clients sharing a token see each other's usage before the server reports it.
+fileratelimit shares the same budgets between processes.
+"""
+
+    estimated_window = 60   # seconds; used until a response reports the real reset
+
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            yield self._state
+
+    def state(self, key):
+        with self.transaction() as st:
+            return json.loads(json.dumps(st.get(key, {})))
+
+    def update(self, key, kind, limit, reset, remaining):
+        now = time.time()
+        with self.transaction() as st:
+            b = st.setdefault(key, {}).get(kind)
+            reset_at = now + reset
+            if b and b['remaining'] is not None and b['reset_at'] and abs(b['reset_at'] - reset_at) < 2:
+                # Same window: other clients may have spent budget since the server answered
+                remaining = min(remaining, b['remaining'])
+            st[key][kind] = {'limit': limit, 'remaining': remaining, 'reset_at': reset_at}
+
+    def acquire(self, key, kinds):
+        """ Takes one call from each kind of budget. Returns 0, or the seconds to wait."""
+        now = time.time()
+        with self.transaction() as st:
+            budgets = st.get(key, {})
+            wait = 0
+            for kind in kinds:
+                b = budgets.get(kind)
+                if not b:
+                    continue
+                if b['reset_at'] is None or now >= b['reset_at']:
+                    # The window is over. Until a response tells us the new one, assume a full
+                    # budget and guess when it ends, so calls that fail without headers still wait.
+                    b['remaining'], b['reset_at'] = b['limit'], now + self.estimated_window
+                if b['remaining'] <= 0:
+                    wait = max(wait, b['reset_at'] - now)
+            if wait:
+                return wait
+            for kind in kinds:
+                if kind in budgets:
+                    budgets[kind]['remaining'] -= 1
+            return 0
+
+
+class fileratelimit(ratelimitstate):
+    """ ratelimitstate kept in a small JSON file and updated under an exclusive flock, so
+every process on the host using the same path shares one budget per token.
+Usage: api.ratelimit_backend = fileratelimit("/tmp/apppy-ratelimit.json")
+"""
+
+    def __init__(self, path):
+        ratelimitstate.__init__(self)
+        self.path = path
+
+    @contextlib.contextmanager
+    def transaction(self):
+        import fcntl
+        with self._lock:
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    data = f.read()
+                    st = json.loads(data) if data else {}
+                    yield st
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(st, f)
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class circuitbreaker(object):
+    """ Per-host circuit breaker. After threshold consecutive failures the circuit opens
+and calls fail fast for cooldown seconds. After that a single probe call is let
+through; if it succeeds the circuit closes again, otherwise it stays open for
+another cooldown."""
+
+    def __init__(self, host, threshold=5, cooldown=30):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def get_state(self):
+        if self.opened is None:
+            return "closed"
+        if time.time() - self.opened >= self.cooldown:
+            return "half-open"
+        return "open"
+    state = property(get_state, None, None, "closed, open or half-open")
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened >= self.cooldown:
+                # Let one probe through; everyone else keeps failing fast until it reports back.
+                self.opened = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+
+
+class retrypolicy(object):
+    """ Retry policy used by genRequest. Assign one to api.retry_policy to enable it.
+Parameters:
+max_retries: Number of retries after the first attempt.
+backoff: Base delay in seconds. Retry n sleeps about backoff * 2**n.
+max_backoff: Upper bound on a single sleep.
+jitter: Fraction of each delay that is randomized (0 disables jitter, 1 is full jitter).
+deadline: Total seconds a call may spend, retries included (None for no limit).
+methods: Methods that are retried after a server error or a dropped connection.
+    429s are retried for every method, since the API did not act on the request.
+statuses: Status codes treated as transient server errors.
+breaker_threshold, breaker_cooldown: see circuitbreaker. One breaker is kept per host.
+
+Counters: retry_count, short_circuit_count, giveup_count
+"""
+
+    def __init__(self, max_retries=5, backoff=0.5, max_backoff=30, jitter=1.0, deadline=120,
+                 methods=("GET", "PUT", "DELETE"), statuses=(500, 502, 503, 504),
+                 breaker_threshold=5, breaker_cooldown=30):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.methods = methods
+        self.statuses = statuses
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breakers = {}
+        self.retry_count = 0
+        self.short_circuit_count = 0
+        self.giveup_count = 0
+        self._lock = threading.Lock()
+
+    def retryable(self, method):
+        return method in self.methods
+
+    def count(self, counter):
+        """ Adds one to counter; policies are shared between threads."""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def breaker(self, host):
+        with self._lock:
+            if host not in self.breakers:
+                self.breakers[host] = circuitbreaker(host, self.breaker_threshold, self.breaker_cooldown)
+            return self.breakers[host]
+
+    def delay(self, attempt, started, retry_after=None):
+        """ Seconds to sleep before retry number attempt+1, or None if the call should give up."""
+        if attempt >= self.max_retries:
+            return None
+        d = min(self.max_backoff, self.backoff * (2 ** attempt))
+        d = d * (1 - self.jitter) + random.uniform(0, d * self.jitter)
+        if retry_after is not None:
+            # App.net asks us to wait at least RetryAfter seconds
+            d = max(d, retry_after)
+        if self.deadline is not None and time.time() + d - started > self.deadline:
+            return None
+        return d
+
+
+class hedgepolicy(object):
+    """ Hedging for GET endpoints. Assign one to api.hedge_policy to enable it.
+When a GET has not answered within the percentile latency observed for its endpoint,
+the same request is sent again and whichever response arrives first is used.
+Parameters:
+percentile: Latency percentile after which to hedge (default 95).
+min_samples: Calls an endpoint needs before it is hedged; its first calls only measure.
+window: Number of recent latencies kept per endpoint.
+min_delay: Never hedge sooner than this many seconds.
+ratio: At most this fraction of hedged calls may fire a hedge.
+reserve: Don't hedge while the global rate limit has this many calls or fewer left.
+workers: Threads used to run hedges. No hedge is sent while all of them are busy.
+
+Counters: calls, fired (hedges sent), won (hedges that answered first)
+"""
+
+    def __init__(self, percentile=95, min_samples=20, window=200, min_delay=0.05,
+                 ratio=0.1, reserve=100, workers=16):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.ratio = ratio
+        self.reserve = reserve
+        self.workers = workers
+        self.latencies = {}
+        self.calls = 0
+        self.fired = 0
+        self.won = 0
+        self.busy = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def pool(self):
+        import concurrent.futures
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+            return self._pool
+
+    def observe(self, endpoint, latency):
+        with self._lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = deque(maxlen=self.window)
+            self.latencies[endpoint].append(latency)
+
+    def threshold(self, endpoint):
+        """ Seconds to wait before hedging a call to endpoint, or None to not hedge it."""
+        with self._lock:
+            lat = sorted(self.latencies.get(endpoint, ()))
+        if len(lat) < self.min_samples:
+            return None
+        return max(self.min_delay, lat[min(len(lat) - 1, int(len(lat) * self.percentile / 100.0))])
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def submit(self, fn, *args, **kargs):
+        with self._lock:
+            self.busy += 1
+        f = self.pool().submit(fn, *args, **kargs)
+        f.add_done_callback(self._done)
+        return f
+
+    def _done(self, f):
+        with self._lock:
+            self.busy -= 1
+
+    def allowed(self, remaining):
+        if remaining is not None and remaining <= self.reserve:
+            return False
+        if self.busy >= self.workers:
+            # a hedge that has to wait for a worker would only add load
+            return False
+        return self.fired < self.ratio * self.calls
+
+    def stats(self):
+        return {'calls': self.calls, 'fired': self.fired, 'won': self.won,
+                'thresholds': dict((e, self.threshold(e)) for e in list(self.latencies))}
+
+
+class priorityscheduler(object):
+    """ Priority lanes within the rate limit budgets. Assign one to api.scheduler.
+Usage:
+api.scheduler = priorityscheduler({'interactive': 0.2, 'normal': 0.1, 'background': 0})
+api.getUser("me", priority="interactive")
+with api.lane("background"):
+    crawl()
+
+lanes maps lane names, highest priority first, to the share of the global and write
+budgets reserved for that lane. It is a dict (ordered on Python 3.7+), an OrderedDict or
+a list of (lane, share) pairs. A call may only spend budget that is not reserved for
+the lanes above it: with the shares above, background calls stop when 30% of a budget
+is left and normal calls when 20% is left, so interactive calls always find some. Calls
+that may not run wait, and run again when responses report more budget or the window
+resets. Calls in flight are counted, so concurrent threads don't all take the last slot;
+with api.ratelimit_backend the shared budget already counts them.
+Calls without a lane use default_lane.
+stats() gives calls, waits and seconds waited per lane.
+"""
+
+    def __init__(self, lanes=None, default_lane='normal'):
+        if lanes is None:
+            lanes = [('interactive', 0.2), ('normal', 0.1), ('background', 0.0)]
+        lanes = OrderedDict(lanes)
+        self.lanes = lanes
+        self.default_lane = default_lane
+        self.floors = {}
+        reserved = 0.0
+        for lane, share in lanes.items():
+            self.floors[lane] = reserved
+            reserved += share
+        self.inflight = {'global': 0, 'write': 0}
+        self.counters = dict((lane, {'calls': 0, 'waits': 0, 'waited': 0.0}) for lane in lanes)
+        self._cond = threading.Condition()
+
+    def _ok(self, api, lane, kinds, key=None):
+        for kind in kinds:
+            limit, remaining, reset_at = api.budget(kind, key)
+            if remaining is None:
+                continue
+            # A shared backend already takes calls in flight off remaining
+            pending = 0 if api.ratelimit_backend else self.inflight[kind]
+            if remaining - pending <= self.floors[lane] * limit:
+                return False, reset_at
+        return True, None
+
+    def lane(self, lane):
+        lane = lane or self.default_lane
+        if lane not in self.lanes:
+            raise ValueError("Unknown lane {0!r}; the lanes are {1}".format(lane, ", ".join(self.lanes)))
+        return lane
+
+    def acquire(self, api, lane, write=False, expires=None, key=None):
+        """ Waits until lane may spend the budget of token key (see ratelimit.budget)."""
+        lane = self.lane(lane)
+        kinds = ('global', 'write') if write else ('global',)
+        started = None
+        with self._cond:
+            while True:
+                ok, reset_at = self._ok(api, lane, kinds, key)
+                if ok:
+                    break
+                now = time.time()
+                if started is None:
+                    started = now
+                    self.counters[lane]['waits'] += 1
+                if expires is not None and now >= expires:
+                    self.counters[lane]['waited'] += now - started
+                    raise DeadlineExceeded("No budget for lane {0} before the deadline".format(lane))
+                wait = 1.0 if reset_at is None else min(1.0, max(0.01, reset_at - now))
+                if expires is not None:
+                    wait = min(wait, expires - now)
+                self._cond.wait(wait)
+            for kind in kinds:
+                self.inflight[kind] += 1
+            self.counters[lane]['calls'] += 1
+            if started is not None:
+                self.counters[lane]['waited'] += time.time() - started
+
+    def try_acquire(self, api, lane, write=False, key=None):
+        """ Like acquire, but returns False instead of waiting."""
+        lane = self.lane(lane)
+        kinds = ('global', 'write') if write else ('global',)
+        with self._cond:
+            if not self._ok(api, lane, kinds, key)[0]:
+                return False
+            for kind in kinds:
+                self.inflight[kind] += 1
+            self.counters[lane]['calls'] += 1
+            return True
+
+    def release(self, write=False):
+        with self._cond:
+            for kind in (('global', 'write') if write else ('global',)):
+                self.inflight[kind] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return json.loads(json.dumps(self.counters))
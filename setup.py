@@ -1,5 +1,6 @@
 from distutils.core import setup
 setup(name='apppy',
-      version='1.2',
-      py_modules=['apppy'],
+      version='1.3',
+      py_modules=['apppy', 'apppy_client', 'apppy_transport', 'apppy_cache', 'apppy_local',
+                  'apppy_streams', 'apppy_tools', 'apppy_async'],
       )
@@ -0,0 +1,461 @@
+""" Tests for the apppy helpers. The API is never called: every test installs a fakeserver
+in api.calls, which answers with queued responses or a handler function.
+Run with python -m pytest or python -m unittest."""
+import asyncio
+import gzip
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from apppy import *
+import apppy_async
+
+
+def response(status=200, body=None, headers=None, method='GET', url='https://alpha-api.app.net/stream/0/'):
+    r = requests.Response()
+    r.status_code = status
+    r._content = json.dumps(body if body is not None else {'data': {}, 'meta': {'code': status}}).encode('utf-8')
+    r.headers.update(headers or {})
+    r.request = requests.Request(method, url).prepare()
+    r.url = url
+    return r
+
+
+def ratelimited(remaining, limit=100, reset=60):
+    return {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Reset': str(reset),
+            'X-RateLimit-Remaining': str(remaining)}
+
+
+class fakeserver(object):
+    """ Stands in for the requests functions in api.calls. Each call takes the next queued
+response (an exception is raised instead), or asks handler(method, url, kargs)."""
+
+    def __init__(self, *responses, **opts):
+        self.responses = list(responses)
+        self.handler = opts.get('handler')
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def install(self, api):
+        api.calls = dict((m, self._call(m)) for m in ('GET', 'PUT', 'DELETE', 'PATCH', 'POST', 'POST-RAW'))
+        return api
+
+    def _call(self, method):
+        def call(url, **kargs):
+            with self._lock:
+                self.requests.append((method, url, kargs))
+                r = self.responses.pop(0) if self.responses else None
+            if r is None:
+                r = self.handler(method, url, kargs) if self.handler else response()
+            if isinstance(r, Exception):
+                raise r
+            r.request = requests.Request(method.replace('-RAW', ''), url).prepare()
+            return r
+        return call
+
+
+def client(*responses, **opts):
+    server = fakeserver(*responses, **opts)
+    return server.install(apppy(access_token='user-token', app_access_token='app-token')), server
+
+
+class test429(unittest.TestCase):
+
+    def test_retried_once_without_policy(self):
+        api, server = client(response(429, headers={'RetryAfter': '0'}), response(200))
+        self.assertEqual(api.getUser('me').status_code, 200)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_second_429_raises_without_policy(self):
+        api, server = client(response(429, headers={'RetryAfter': '0'}),
+                             response(429, headers={'RetryAfter': '0'}))
+        self.assertRaises(requests.exceptions.HTTPError, api.getUser, 'me')
+        self.assertEqual(len(server.requests), 2)
+
+    def test_gimme_429(self):
+        api, server = client(response(429, headers={'RetryAfter': '0'}))
+        api.gimme_429 = True
+        self.assertRaises(requests.exceptions.HTTPError, api.getUser, 'me')
+        self.assertEqual(len(server.requests), 1)
+
+
+class testretrypolicy(unittest.TestCase):
+
+    def policy(self, **opts):
+        kargs = dict(max_retries=2, backoff=0, jitter=0, breaker_threshold=10, breaker_cooldown=0.05)
+        kargs.update(opts)
+        return retrypolicy(**kargs)
+
+    def test_retries_then_gives_up(self):
+        api, server = client(response(503), response(503), response(503))
+        api.retry_policy = self.policy()
+        self.assertEqual(api.getUser('me').status_code, 503)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(api.retry_policy.retry_count, 2)
+        self.assertEqual(api.retry_policy.giveup_count, 1)
+
+    def test_retries_dropped_connections(self):
+        api, server = client(requests.exceptions.ConnectionError("reset"), response(200))
+        api.retry_policy = self.policy()
+        self.assertEqual(api.getUser('me').status_code, 200)
+        self.assertEqual(api.retry_policy.retry_count, 1)
+
+    def test_writes_not_retried_on_5xx(self):
+        api, server = client(response(503, method='POST'))
+        api.retry_policy = self.policy()
+        self.assertEqual(api.createPost(text="hi").status_code, 503)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(api.retry_policy.retry_count, 0)
+
+    def test_breaker_opens_and_closes(self):
+        api, server = client(response(503), response(503))
+        api.retry_policy = self.policy(max_retries=0, breaker_threshold=2)
+        api.getUser('me')
+        api.getUser('me')
+        breaker = api.retry_policy.breakers['alpha-api.app.net']
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, api.getUser, 'me')
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(api.retry_policy.short_circuit_count, 1)
+        time.sleep(0.06)
+        self.assertEqual(api.getUser('me').status_code, 200)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_429_closes_half_open_breaker(self):
+        api, server = client(response(503, method='POST'), response(429, headers={'RetryAfter': '0'}),
+                             response(200))
+        api.retry_policy = self.policy(max_retries=1, breaker_threshold=1)
+        api.createPost(text="hi")
+        time.sleep(0.06)
+        self.assertEqual(api.getUser('me').status_code, 200)
+        self.assertEqual(api.retry_policy.breakers['alpha-api.app.net'].state, 'closed')
+
+
+class testdeadline(unittest.TestCase):
+
+    def test_long_retry_after(self):
+        api, server = client(response(429, headers={'RetryAfter': '30'}))
+        started = time.time()
+        self.assertRaises(DeadlineExceeded, api.getUser, 'me', deadline=1)
+        self.assertLess(time.time() - started, 1)
+
+    def test_long_retry_after_with_policy(self):
+        api, server = client(response(429, headers={'RetryAfter': '30'}))
+        api.retry_policy = retrypolicy(deadline=None)
+        api.deadline = 1
+        self.assertRaises(DeadlineExceeded, api.getUser, 'me')
+        self.assertEqual(len(server.requests), 1)
+
+    def test_timeout_is_capped(self):
+        api, server = client()
+        api.getUser('me', deadline=5, timeout=(10, 2))
+        connect, read = server.requests[0][2]['timeout']
+        self.assertLessEqual(connect, 5)
+        self.assertEqual(read, 2)
+
+    def test_deadline_timeouts_not_counted_by_breaker(self):
+        api, server = client(handler=lambda m, u, k: requests.exceptions.ReadTimeout("slow"))
+        api.retry_policy = retrypolicy(breaker_threshold=1)
+        for i in range(3):
+            self.assertRaises(DeadlineExceeded, api.getUser, 'me', deadline=0.05)
+        self.assertEqual(api.retry_policy.breakers['alpha-api.app.net'].state, 'closed')
+
+
+class testratelimit(unittest.TestCase):
+
+    def test_headers_are_read(self):
+        api, server = client(response(headers=ratelimited(90)))
+        api.getUser('me')
+        self.assertEqual(api.gremaining, 90)
+        self.assertEqual(api.budget()[:2], (100, 90))
+
+    def test_shared_budget(self):
+        backend = ratelimitstate()
+        api1, server = client(response(headers=ratelimited(10)))
+        api2, server = client()
+        api1.ratelimit_backend = api2.ratelimit_backend = backend
+        api1.getUser('me')
+        api2.getUser('me')
+        self.assertEqual(api1.gremaining, 9)
+
+    def test_window_end_without_headers(self):
+        state = ratelimitstate()
+        state.update('k', 'global', 2, 0, 2)
+        time.sleep(0.01)
+        self.assertEqual(state.acquire('k', ('global',)), 0)
+        self.assertEqual(state.acquire('k', ('global',)), 0)
+        self.assertGreater(state.acquire('k', ('global',)), 0)
+
+    def test_app_token_budget(self):
+        api, server = client()
+        api.ratelimit_backend = ratelimitstate()
+        api.scheduler = priorityscheduler()
+        api.ratelimit_backend.update(api.ratelimit_key('app-token'), 'global', 100, 60, 20)
+        api.ratelimit_backend.update(api.ratelimit_key(), 'global', 100, 60, 100)
+        self.assertEqual(api.getUser('me', priority='background').status_code, 200)
+        self.assertRaises(DeadlineExceeded, api.getAllAppStream, priority='background', deadline=0.1)
+
+
+class testscheduler(unittest.TestCase):
+
+    def test_lanes_keep_their_order(self):
+        s = priorityscheduler([('interactive', 0.05), ('normal', 0.1), ('background', 0)])
+        self.assertEqual(list(s.lanes), ['interactive', 'normal', 'background'])
+        self.assertEqual(s.floors['interactive'], 0)
+
+    def test_unknown_lane(self):
+        api, server = client()
+        api.scheduler = priorityscheduler()
+        self.assertRaises(ValueError, api.getUser, 'me', priority='urgent')
+
+    def test_lane_floor(self):
+        api, server = client(response(headers=ratelimited(25)))
+        api.scheduler = priorityscheduler()
+        api.getUser('me')
+        self.assertRaises(DeadlineExceeded, api.getUser, 'me', priority='background', deadline=0.1)
+        self.assertEqual(api.getUser('me', priority='interactive').status_code, 200)
+        self.assertEqual(api.scheduler.inflight, {'global': 0, 'write': 0})
+
+    def test_backend_calls_counted_once(self):
+        api, server = client()
+        api.ratelimit_backend = ratelimitstate()
+        api.scheduler = priorityscheduler()
+        api.ratelimit_backend.update(api.ratelimit_key(), 'global', 100, 60, 31)
+        self.assertEqual(api.getUser('me', priority='background').status_code, 200)
+
+    def test_lane_context(self):
+        api, server = client()
+        api.scheduler = priorityscheduler()
+        with api.lane('background'):
+            api.getUser('me')
+        self.assertEqual(api.scheduler.stats()['background']['calls'], 1)
+
+
+class testexporter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.messages = [str(i) for i in range(5, 0, -1)]
+        self.fail_before = None
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def handler(self, method, url, kargs):
+        params = kargs.get('params', {})
+        if url.endswith('/channels'):
+            return response(body={'data': [{'id': 'c1'}], 'meta': {'more': False}})
+        if url.endswith('/files'):
+            return response(body={'data': [], 'meta': {'more': False}})
+        if self.fail_before and params.get('before_id') == self.fail_before:
+            return requests.exceptions.ConnectionError("dropped")
+        ids = [i for i in self.messages
+               if int(i) < int(params.get('before_id', 1 << 62)) and int(i) > int(params.get('since_id', 0))]
+        page = ids[:params['count']]
+        meta = {'more': len(ids) > len(page)}
+        if page:
+            meta.update(min_id=page[-1], max_id=page[0])
+        return response(body={'data': [{'id': i, 'channel_id': 'c1'} for i in page], 'meta': meta})
+
+    def exported(self):
+        with gzip.open(os.path.join(self.directory, 'messages', 'c1.ndjson.gz')) as f:
+            return [json.loads(line)['id'] for line in f.read().decode('utf-8').splitlines()]
+
+    def test_resumes_where_it_stopped(self):
+        api, server = client(handler=self.handler)
+        self.fail_before = '4'
+        self.assertRaises(requests.exceptions.ConnectionError, api.exportAccount, self.directory, count=2)
+        with open(os.path.join(self.directory, 'state.json')) as f:
+            state = json.load(f)['messages/c1']
+        self.assertEqual(state, {'max_id': None, 'cursor': '4', 'top': '5'})
+
+        self.fail_before = None
+        del server.requests[:]
+        api.exportAccount(self.directory, count=2)
+        firsts = [k['params'] for m, u, k in server.requests if '/messages' in u]
+        self.assertEqual(firsts[0].get('before_id'), '4')
+        self.assertEqual(self.exported(), ['5', '4', '3', '2', '1'])
+
+        self.messages.insert(0, '6')
+        del server.requests[:]
+        api.exportAccount(self.directory, count=2)
+        firsts = [k['params'] for m, u, k in server.requests if '/messages' in u]
+        self.assertEqual(firsts[0].get('since_id'), '5')
+        self.assertEqual(self.exported(), ['5', '4', '3', '2', '1', '6'])
+
+
+class testunreadtracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = unreadtracker(None, me='me')
+        self.tracker.channel({'id': 'c1', 'type': 'net.app.core.pm', 'has_unread': False,
+                              'marker': {'last_read_id': '100'}, 'recent_message_id': '100'})
+
+    def message(self, mid, user='other'):
+        return {'id': str(mid), 'channel_id': 'c1', 'user': {'id': user}}
+
+    def test_channel_updates(self):
+        for mid in (101, 102, 103):
+            self.tracker.feed({'meta': {'type': 'channel'},
+                               'data': {'id': 'c1', 'type': 'net.app.core.pm', 'has_unread': True,
+                                        'recent_message_id': str(mid), 'recent_message': self.message(mid)}})
+        self.assertEqual(self.tracker.count('c1'), 3)
+        self.assertEqual(self.tracker.total(), 1)
+
+    def test_messages_and_markers(self):
+        self.tracker.feed({'meta': {'type': 'message'}, 'data': self.message(101)})
+        self.tracker.feed({'meta': {'type': 'message'}, 'data': self.message(102)})
+        self.assertEqual(self.tracker.count('c1'), 2)
+        self.tracker.feed({'meta': {'type': 'message', 'is_deleted': True}, 'data': self.message(102)})
+        self.assertEqual(self.tracker.count('c1'), 1)
+        self.tracker.feed({'meta': {'type': 'stream_marker'},
+                           'data': {'name': 'channel:c1', 'id': '102', 'last_read_id': '102'}})
+        self.assertEqual(self.tracker.count('c1'), 0)
+        self.assertEqual(self.tracker.total('net.app.core.pm'), 0)
+
+    def test_own_message_marks_read(self):
+        self.tracker.feed({'meta': {'type': 'message'}, 'data': self.message(101)})
+        self.tracker.feed({'meta': {'type': 'message'}, 'data': self.message(102, user='me')})
+        self.assertEqual(self.tracker.count('c1'), 0)
+
+    def test_deleted_channel(self):
+        self.tracker.feed({'meta': {'type': 'message'}, 'data': self.message(101)})
+        self.tracker.feed({'meta': {'type': 'channel', 'is_deleted': True, 'id': 'c1'}, 'data': {'id': 'c1'}})
+        self.assertEqual(self.tracker.count('c1'), 0)
+        self.assertEqual(self.tracker.total(), 0)
+
+    def test_ignored_types(self):
+        self.tracker.feed({'meta': {'type': 'channel'}, 'data': {'id': 'c2', 'type': 'com.example.chat',
+                                                                 'has_unread': True}})
+        self.tracker.feed({'meta': {'type': 'message'}, 'data': {'id': '5', 'channel_id': 'c2'}})
+        self.assertEqual(self.tracker.count('c2'), 0)
+
+
+class testurlargs(unittest.TestCase):
+
+    def test_round_trip(self):
+        api = apppy()
+        seen = []
+        api.genRequest = lambda url, ep, params: seen.append((url, ep))
+        tested = 0
+        for name, method in inspect.getmembers(api, inspect.ismethod):
+            spec = inspect.getfullargspec(method)
+            if not spec.varkw or name not in vars(apppy):
+                continue
+            args = ['arg{0}x'.format(i) for i in range(len(spec.args) - 1 - len(spec.defaults or ()))]
+            del seen[:]
+            method(*args)
+            if not seen:
+                continue
+            url, ep = seen[0]
+            if len(args) != len(ep['url_params']):
+                continue
+            self.assertEqual(api.urlargs(ep, url), args, name)
+            tested += 1
+        self.assertGreater(tested, 100)
+
+    def test_destroy_subscription_url(self):
+        api, server = client()
+        api.destroySubscriptionUserStream('conn', 'sub')
+        self.assertTrue(server.requests[0][1].endswith('/streams/me/streams/conn/subscriptions/sub'))
+
+
+class testplacecache(unittest.TestCase):
+
+    def places(self, n):
+        return [{'factual_id': 'f{0}'.format(i), 'name': 'Cafe {0}'.format(i),
+                 'latitude': 52.37 + (n - i) * 0.0001, 'longitude': 4.89} for i in range(n)]
+
+    def test_repeated_search_returns_server_results(self):
+        api, server = client(response(body={'data': [{'factual_id': 'sb', 'name': 'Starbucks',
+                                                      'latitude': 52.37, 'longitude': 4.89}]}))
+        cache = placecache()
+        first = cache.search(api, 52.37, 4.89, 500, q='coffee')
+        self.assertEqual(cache.search(api, 52.37, 4.89, 500, q='coffee'), first)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(cache.hits, 1)
+
+    def test_eviction_drops_covering_search(self):
+        api, server = client(handler=lambda m, u, k: response(body={'data': self.places(3)}))
+        cache = placecache(maxsize=2)
+        cache.search(api, 52.37, 4.89, 500)
+        self.assertEqual(len(cache.search(api, 52.37, 4.89, 500)), 3)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_same_order_from_cache_and_api(self):
+        api, server = client(handler=lambda m, u, k: response(body={'data': self.places(3)}))
+        cache = placecache()
+        fetched = cache.search(api, 52.37, 4.89, 500, q='cafe')
+        self.assertEqual(cache.search(api, 52.37, 4.89, 500, q='cafe'), fetched)
+        self.assertEqual([p['factual_id'] for p in fetched], ['f2', 'f1', 'f0'])
+
+
+class testcoalescingwriter(unittest.TestCase):
+
+    def test_latest_marker_wins(self):
+        api, server = client()
+        writer = coalescingwriter(api, interval=None)
+        for i in range(5):
+            writer.updateMarker(name='global', id=str(i))
+        writer.close()
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(json.loads(server.requests[0][2]['data'])['id'], '4')
+        self.assertEqual(writer.stats()['absorbed'], 4)
+
+
+class testuserstreammux(unittest.TestCase):
+
+    def run_mux(self, responses, test):
+        # responses: what the stream server answers to each connection, in turn
+        connections = []
+
+        async def serve(reader, writer):
+            await reader.readuntil(b"\r\n\r\n")
+            connections.append(writer)
+            writer.write(responses[min(len(connections), len(responses)) - 1])
+            await writer.drain()
+            writer.close()
+
+        async def main():
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            mux = apppy_async.userstreammux()
+            mux.host, mux.port, mux.use_ssl, mux._ssl = '127.0.0.1', server.sockets[0].getsockname()[1], False, None
+            try:
+                await asyncio.wait_for(test(mux), 10)
+            finally:
+                server.close()
+        asyncio.run(main())
+
+    def api(self):
+        return client(handler=lambda m, u, k: response(body={'meta': {'subscription_id': 's'}}))[0]
+
+    def test_failed_first_connect(self):
+        async def test(mux):
+            mux.port = 1
+            with self.assertRaises(OSError):
+                await mux.add('a', api=self.api())
+            self.assertEqual(mux.streams, {})
+        self.run_mux([b""], test)
+
+    def test_refused_token_reported(self):
+        ok = b"HTTP/1.1 200 OK\r\nConnection-Id: C1\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n"
+        refused = b"HTTP/1.1 401 Unauthorized\r\n\r\n"
+
+        async def test(mux):
+            await mux.add('a', api=self.api())
+            account, event = await mux.queue.get()
+            self.assertEqual((account, event['meta']['type']), ('a', 'error'))
+            self.assertEqual(mux.streams, {})
+            await mux.remove('a')
+        self.run_mux([ok, refused], test)
+
+
+if __name__ == '__main__':
+    unittest.main()